@@ -6,6 +6,7 @@ without an exception being thrown.
 import pytest
 
 from videoflow.core import Flow
+from videoflow.core.constants import BATCH
 from videoflow.core.node import TaskModuleNode
 from videoflow.producers import IntProducer
 from videoflow.processors import IdentityProcessor, JoinerProcessor
@@ -81,6 +82,26 @@ def test_graph_with_no_consumer():
     flow.run()
     flow.join()
 
+@pytest.mark.timeout(30)
+def test_forkserver_example1():
+    producer = IntProducer(0, 40, 0.01)
+    identity = IdentityProcessor()(producer)
+    identity1 = IdentityProcessor(nb_tasks = 2)(identity)
+    joined = JoinerProcessor()(identity, identity1)
+    printer = CommandlineConsumer()(joined)
+    flow = Flow([producer], [printer], start_method = 'forkserver')
+    flow.run()
+    flow.join()
+
+@pytest.mark.timeout(30)
+def test_spawn_example1():
+    producer = IntProducer(0, 40, 0.01)
+    identity = IdentityProcessor(nb_tasks = 3)(producer)
+    printer = CommandlineConsumer()(identity)
+    flow = Flow([producer], [printer], flow_type = BATCH, start_method = 'spawn')
+    flow.run()
+    flow.join()
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
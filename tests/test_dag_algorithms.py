@@ -1,8 +1,9 @@
 import pytest
 
-from videoflow.utils.graph import has_cycle, topological_sort
+from videoflow.utils.graph import has_cycle, topological_sort, message_ids_read_after
 from videoflow.producers import IntProducer
 from videoflow.processors import IdentityProcessor, JoinerProcessor
+from videoflow.core.bottlenecks import MetadataConsumer
 
 def test_topological_sort():
     a = IntProducer()
@@ -60,5 +61,21 @@ def test_cycle_detection():
     assert has_cycle([e2]), '#4 Cycle not detected'
     assert has_cycle([a2]), "#5 Cycle not detected"
 
+def test_message_ids_read_after():
+    a = IntProducer()
+    b = IdentityProcessor()(a)
+    c = IdentityProcessor()(b)
+    d = JoinerProcessor()(b, c)
+    tsort = [a, b, c, d]
+    metadata = MetadataConsumer()(*tsort)
+    tsort.append(metadata)
+
+    read_after = message_ids_read_after(tsort)
+    assert read_after[0] == frozenset([a.id, b.id, c.id])
+    assert read_after[1] == frozenset([b.id, c.id])
+    assert read_after[2] == frozenset([b.id, c.id])
+    assert read_after[3] == frozenset()
+    assert read_after[4] == frozenset()
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
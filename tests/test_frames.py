@@ -0,0 +1,169 @@
+'''
+Tests the shared memory arenas used to pass numpy frames
+between tasks.
+'''
+import os
+import errno
+
+import pytest
+import numpy as np
+from multiprocessing import Value
+
+from videoflow.core import Flow
+from videoflow.core.constants import BATCH, STOP_SIGNAL
+from videoflow.core.task import MultiprocessingReceiveTask
+from videoflow.core.node import ProducerNode, ConsumerNode
+from videoflow.engines.batch import _nb_slabs_per_node
+from videoflow.engines.frames import SharedFrame, SharedFrameRegistry, decode_frame, shared_memory, MIN_FRAME_BYTES, DEFAULT_NB_SLABS
+from videoflow.processors import JoinerProcessor
+
+import videoflow.core.task
+
+NB_FRAMES = 200
+
+requires_shared_memory = pytest.mark.skipif(shared_memory is None,
+    reason = 'multiprocessing.shared_memory requires Python >= 3.8')
+
+class FrameProducer(ProducerNode):
+    '''
+    Produces ``nb_frames`` frames, each one filled with its index modulo 256.
+    '''
+    def __init__(self, nb_frames):
+        self._nb_frames = nb_frames
+        self._count = 0
+        super(FrameProducer, self).__init__()
+
+    def next(self):
+        if self._count >= self._nb_frames:
+            raise StopIteration()
+        frame = np.full((256, 256, 3), self._count % 256, dtype = np.uint8)
+        self._count += 1
+        return frame
+
+class JoinedFrameChecker(ConsumerNode):
+    '''
+    Counts the frames received inside a tuple, and the ones that do not \
+    hold the index expected.
+    '''
+    def __init__(self, nb_received, nb_bad):
+        self._nb_received = nb_received
+        self._nb_bad = nb_bad
+        super(JoinedFrameChecker, self).__init__()
+
+    def consume(self, item):
+        if not np.all(item[0] == self._nb_received.value % 256):
+            self._nb_bad.value += 1
+        self._nb_received.value += 1
+
+@requires_shared_memory
+def test_frame_round_trip():
+    registry = SharedFrameRegistry([0], nb_slabs = 2)
+    frame = np.random.randint(0, 255, size = (240, 320, 3), dtype = np.uint8)
+    encoded = registry.encode(0, frame)
+    assert isinstance(encoded, SharedFrame)
+    decoded = decode_frame(encoded)
+    assert np.array_equal(decoded, frame)
+
+    # Nodes get their own copy of the frame
+    decoded[...] = 0
+    assert np.array_equal(decode_frame(encoded), frame)
+    registry.unlink()
+
+class PreviousFrameChecker(ConsumerNode):
+    '''
+    Keeps the previous frame received, and counts the frames received \
+    and the times the previous frame does not hold its index anymore.
+    '''
+    def __init__(self, nb_received, nb_bad):
+        self._nb_received = nb_received
+        self._nb_bad = nb_bad
+        self._previous = None
+        super(PreviousFrameChecker, self).__init__()
+
+    def consume(self, item):
+        if self._previous is not None and not np.all(self._previous == (self._nb_received.value - 1) % 256):
+            self._nb_bad.value += 1
+        self._previous = item
+        self._nb_received.value += 1
+
+def test_small_arrays_not_encoded():
+    registry = SharedFrameRegistry([0])
+    small = np.zeros(MIN_FRAME_BYTES // 2, dtype = np.uint8)
+    assert registry.encode(0, small) is small
+    assert registry.encode(1, 'not a frame') == 'not a frame'
+    registry.unlink()
+
+@requires_shared_memory
+def test_slabs_are_released():
+    registry = SharedFrameRegistry([0], nb_slabs = 1)
+    frame = np.ones((256, 256), dtype = np.float32)
+    first = registry.encode(0, frame)
+    assert isinstance(first, SharedFrame)
+
+    # No free slabs left: the array is sent as is.
+    assert registry.encode(0, frame) is frame
+
+    message_dict = {0: {'message': first, 'metadata': None}}
+    registry.release(message_dict)
+    assert message_dict[0]['message'] is None
+    assert isinstance(registry.encode(0, frame), SharedFrame)
+    registry.unlink()
+
+def test_slabs_cover_batches_below():
+    # a -> b -> c, where c only reads the output of b.
+    read_after = [frozenset(['a', 'b']), frozenset(['b']), frozenset()]
+    nb_slabs = _nb_slabs_per_node(['a', 'b', 'c'], [4, 4, 1], [1, 1, 0], read_after)
+    # Each batched edge holds a pending batch and a queued one: 6 more messages than default.
+    assert nb_slabs == {'a': DEFAULT_NB_SLABS + 12, 'b': DEFAULT_NB_SLABS + 6, 'c': DEFAULT_NB_SLABS}
+    assert _nb_slabs_per_node(['a', 'b', 'c'], [1, 1, 1], [1, 1, 0], read_after) == \
+        {'a': DEFAULT_NB_SLABS, 'b': DEFAULT_NB_SLABS, 'c': DEFAULT_NB_SLABS}
+
+def test_full_shm_disables_arena(monkeypatch):
+    def no_space(fd, offset, length):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(os, 'posix_fallocate', no_space, raising = False)
+    registry = SharedFrameRegistry([0])
+    frame = np.ones((256, 256), dtype = np.float32)
+    assert registry.encode(0, frame) is frame
+    registry.unlink()
+
+def test_joined_frames_not_overwritten():
+    # The joiner publishes a tuple that holds the frame of the producer.
+    # Nobody after the joiner reads the message of the producer, so its
+    # slab is given back, but not before the tuple has been sent.
+    nb_received, nb_bad = Value('i', 0), Value('i', 0)
+    producer = FrameProducer(NB_FRAMES)
+    joiner = JoinerProcessor()(producer)
+    checker = JoinedFrameChecker(nb_received, nb_bad)(joiner)
+    flow = Flow([producer], [checker], flow_type = BATCH)
+    flow.run()
+    flow.join()
+    assert nb_received.value == NB_FRAMES
+    assert nb_bad.value == 0
+
+def test_kept_frames_not_overwritten():
+    # The consumer keeps the previous frame after the slab it came in was given back.
+    nb_received, nb_bad = Value('i', 0), Value('i', 0)
+    producer = FrameProducer(NB_FRAMES)
+    checker = PreviousFrameChecker(nb_received, nb_bad)(producer)
+    flow = Flow([producer], [checker], flow_type = BATCH)
+    flow.run()
+    flow.join()
+    assert nb_received.value == NB_FRAMES
+    assert nb_bad.value == 0
+
+def test_stop_check_does_not_decode(monkeypatch):
+    # Only the worker that processes a message needs its frames.
+    def decode_frame_mock(message):
+        raise AssertionError('frame decoded')
+    monkeypatch.setattr(videoflow.core.task, 'decode_frame', decode_frame_mock)
+
+    producer = FrameProducer(1)
+    joiner = JoinerProcessor()(producer)
+    task = MultiprocessingReceiveTask(joiner, None, None, BATCH)
+    frame = SharedFrame(producer.id, 'vf_test', 0, 0, (256, 256, 3), '|u1')
+    assert not task._has_stop_signal({producer.id: {'message': frame, 'metadata': None}})
+    assert task._has_stop_signal({producer.id: {'message': STOP_SIGNAL, 'metadata': None}})
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,55 @@
+'''
+Tests the messengers used by the execution engines to pass
+messages between tasks.
+'''
+import pytest
+from queue import Queue
+
+from videoflow.core.constants import STOP_SIGNAL
+from videoflow.engines.batch import BatchprocessingQueueMessenger
+from videoflow.producers import IntProducer
+from videoflow.processors import IdentityProcessor
+
+def test_batch_messenger_batches_messages():
+    producer = IntProducer()
+    identity = IdentityProcessor()(producer)
+    queue = Queue()
+    publisher = BatchprocessingQueueMessenger(producer, queue, None, None, batch_size = 3)
+    receiver = BatchprocessingQueueMessenger(identity, None, queue, None)
+
+    for i in range(4):
+        publisher.publish_message(i)
+    assert queue.qsize() == 1
+    publisher.publish_termination_message(STOP_SIGNAL)
+    assert queue.qsize() == 2
+
+    received = [receiver.receive_message()[0]['message'] for _ in range(5)]
+    assert received == [0, 1, 2, 3, STOP_SIGNAL]
+
+def test_batch_messenger_receives_single_messages():
+    producer = IntProducer()
+    identity = IdentityProcessor()(producer)
+    queue = Queue()
+    publisher = BatchprocessingQueueMessenger(producer, queue, None, None)
+    receiver = BatchprocessingQueueMessenger(identity, None, queue, None)
+
+    publisher.publish_message(7)
+    assert receiver.receive_message()[0]['message'] == 7
+
+def test_batch_messenger_drops_unread_messages():
+    producer = IntProducer()
+    identity = IdentityProcessor()(producer)
+    in_queue, out_queue = Queue(), Queue()
+    publisher = BatchprocessingQueueMessenger(producer, in_queue, None, None)
+    messenger = BatchprocessingQueueMessenger(identity, out_queue, in_queue, None,
+                                    read_after = frozenset([identity.id]))
+
+    publisher.publish_message(1, 'metadata')
+    messenger.receive_message()
+    messenger.publish_message(2)
+    published = out_queue.get()
+    assert published[producer.id] == {'message': None, 'metadata': 'metadata'}
+    assert published[identity.id]['message'] == 2
+
+if __name__ == "__main__":
+    pytest.main([__file__])
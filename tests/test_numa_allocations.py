@@ -0,0 +1,82 @@
+'''
+Tests the placement of tasks on the NUMA nodes of the machine.
+'''
+import pytest
+
+from videoflow.core.constants import GPU
+from videoflow.core.flow import _task_data_from_node_tsort
+from videoflow.engines.realtime import RealtimeExecutionEngine
+from videoflow.utils.graph import topological_sort
+from videoflow.producers import IntProducer
+from videoflow.processors import IdentityProcessor
+from videoflow.consumers import CommandlineConsumer
+
+import videoflow.engines.realtime
+import videoflow.engines.task_functions
+
+NUMA_NODES = [set(range(0, 16)), set(range(16, 32))]
+
+def _allocated_cpus(monkeypatch, numa_pinning):
+    allocated = []
+    create_process_task = videoflow.engines.realtime.create_process_task
+    def create_process_task_mock(task, ctx = None, cpus = None):
+        allocated.append(cpus)
+        return create_process_task(task, ctx, cpus)
+
+    monkeypatch.setattr(videoflow.engines.realtime, 'get_numa_nodes_cpus', lambda: NUMA_NODES)
+    monkeypatch.setattr(videoflow.engines.realtime, 'create_process_task', create_process_task_mock)
+
+    A = IntProducer()
+    B = IdentityProcessor()(A)
+    C = IdentityProcessor()(B)
+    D = CommandlineConsumer()(C)
+
+    tsort = topological_sort([A])
+    tasks_data = _task_data_from_node_tsort(tsort)
+
+    ee = RealtimeExecutionEngine(numa_pinning = numa_pinning)
+    ee._al_create_processes(tasks_data)
+    return allocated
+
+def test_numa_pinning_off_by_default(monkeypatch):
+    #1. Test that tasks are not pinned unless asked for
+    allocated = _allocated_cpus(monkeypatch, False)
+    assert allocated == [None] * 4
+
+def test_numa_pinning_balanced(monkeypatch):
+    #2. Test that consecutive tasks share a node, and that both nodes are used
+    allocated = _allocated_cpus(monkeypatch, True)
+    assert allocated == [NUMA_NODES[0]] * 2 + [NUMA_NODES[1]] * 2
+
+def _gpu_allocated_cpus(monkeypatch, numa_pinning):
+    allocated = []
+    create_process_task_gpu = videoflow.engines.realtime.create_process_task_gpu
+    def create_process_task_gpu_mock(task, gpu_id, ctx = None, cpus = None):
+        allocated.append(cpus)
+        return create_process_task_gpu(task, gpu_id, ctx, cpus)
+
+    monkeypatch.setattr(videoflow.engines.realtime, 'get_numa_nodes_cpus', lambda: NUMA_NODES)
+    monkeypatch.setattr(videoflow.engines.realtime, 'get_gpu_local_cpus', lambda gpu_id: NUMA_NODES[1])
+    monkeypatch.setattr(videoflow.engines.realtime, 'create_process_task_gpu', create_process_task_gpu_mock)
+    monkeypatch.setattr(videoflow.engines.task_functions, 'get_gpu_environ', lambda gpu_id: {})
+
+    A = IntProducer()
+    B = IdentityProcessor(device_type = GPU)(A)
+    C = CommandlineConsumer()(B)
+
+    tsort = topological_sort([A])
+    tasks_data = _task_data_from_node_tsort(tsort)
+
+    ee = RealtimeExecutionEngine(numa_pinning = numa_pinning)
+    ee._gpu_ids = [0]
+    ee._nb_available_gpus = 1
+    ee._al_create_processes(tasks_data)
+    return allocated
+
+def test_gpu_task_pinned_only_with_numa_pinning(monkeypatch):
+    #3. Test that gpu tasks are kept on the cpus local to their gpu only if asked for
+    assert _gpu_allocated_cpus(monkeypatch, False) == [None]
+    assert _gpu_allocated_cpus(monkeypatch, True) == [NUMA_NODES[1]]
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,162 @@
+'''
+Tests the queues used by the execution engines to communicate
+between tasks.
+'''
+import os
+import errno
+
+import pytest
+import numpy as np
+import multiprocessing
+from queue import Full, Empty
+from multiprocessing import Process
+
+from videoflow.core.constants import STOP_SIGNAL
+from videoflow.core.flow import _task_data_from_node_tsort
+from videoflow.core.task import MultiprocessingProcessorTask
+from videoflow.engines.queues import SPSCShmQueue, create_queue, create_accounting_queue, shared_memory
+from videoflow.engines.realtime import RealtimeExecutionEngine
+from videoflow.utils.graph import topological_sort
+from videoflow.producers import IntProducer
+from videoflow.processors import IdentityProcessor
+from videoflow.consumers import CommandlineConsumer
+
+def _producer_fn(queue, n):
+    for i in range(n):
+        queue.put({i: {'message': i, 'metadata': None}})
+
+requires_shared_memory = pytest.mark.skipif(shared_memory is None,
+    reason = 'multiprocessing.shared_memory requires Python >= 3.8')
+
+@requires_shared_memory
+def test_spsc_order():
+    queue = SPSCShmQueue(3)
+    for i in range(3):
+        queue.put(i)
+    assert queue.full()
+    assert [queue.get() for _ in range(3)] == [0, 1, 2]
+    assert queue.empty()
+
+@requires_shared_memory
+def test_spsc_overflow():
+    queue = SPSCShmQueue(2, slot_bytes = 16)
+    big = 'a' * 1000
+    queue.put(big)
+    queue.put(1)
+    assert queue.get() == big
+    assert queue.get() == 1
+
+@requires_shared_memory
+def test_spsc_non_blocking():
+    queue = SPSCShmQueue(1)
+    with pytest.raises(Empty):
+        queue.get(block = False)
+    queue.put(0, block = False)
+    with pytest.raises(Full):
+        queue.put(1, block = False)
+
+@requires_shared_memory
+def test_spsc_across_processes():
+    queue = SPSCShmQueue(2)
+    proc = Process(target = _producer_fn, args = (queue, 50))
+    proc.start()
+    for i in range(50):
+        assert queue.get() == {i: {'message': i, 'metadata': None}}
+    proc.join()
+
+@requires_shared_memory
+def test_spsc_numpy_arrays():
+    queue = SPSCShmQueue(2, slot_bytes = 1 << 16)
+    small = np.arange(100, dtype = np.float32).reshape(10, 10)
+    big = np.random.randint(0, 255, size = (240, 320, 3), dtype = np.uint8)
+    fortran = np.asfortranarray(small)
+    queue.put({0: {'message': small, 'metadata': None}, 1: {'message': fortran, 'metadata': None}})
+    queue.put(big[:, ::2])
+    received = queue.get()
+    assert np.array_equal(received[0]['message'], small)
+    assert np.array_equal(received[1]['message'], fortran)
+    assert np.array_equal(queue.get(), big[:, ::2])
+
+def test_full_shm_falls_back_to_queue(monkeypatch):
+    def no_space(fd, offset, length):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(os, 'posix_fallocate', no_space, raising = False)
+    q = create_queue(2)
+    assert not isinstance(q, SPSCShmQueue)
+    q.put(1)
+    assert q.get() == 1
+
+def test_accounting_queue_order():
+    # The output task reads the outputs of the workers in the order of the
+    # indices in the accounting queue, which must be the order of the inputs.
+    ctx = multiprocessing.get_context()
+    producer = IntProducer()
+    identity = IdentityProcessor(nb_tasks = 3)(producer)
+    receive_queue = ctx.Queue(1)
+    accounting_queue = create_accounting_queue(ctx)
+    output_queues = [ctx.Queue() for _ in range(3)]
+    lock = ctx.Lock()
+    procs = [
+        Process(target = MultiprocessingProcessorTask(idx, identity, lock, receive_queue,
+                                            accounting_queue, output_queues[idx]).run)
+        for idx in range(3)
+    ]
+    for proc in procs:
+        proc.start()
+    for i in range(500):
+        receive_queue.put({producer.id: {'message': i, 'metadata': None}})
+    receive_queue.put({producer.id: {'message': STOP_SIGNAL, 'metadata': None}})
+
+    received = []
+    nb_stopped = 0
+    while nb_stopped < 3:
+        message = output_queues[accounting_queue.get()].get()[identity.id]['message']
+        if message == STOP_SIGNAL:
+            nb_stopped += 1
+        else:
+            received.append(message)
+    for proc in procs:
+        proc.join()
+    assert received == list(range(500))
+
+def test_queue_depth():
+    #1. Test that the queue a processor reads from has the depth it asks for
+    A = IntProducer()
+    B = IdentityProcessor(queue_depth = 4)(A)
+    C = IdentityProcessor()(B)
+    D = CommandlineConsumer()(C)
+
+    tsort = topological_sort([A])
+    tasks_data = _task_data_from_node_tsort(tsort)
+    assert [data[4] for data in tasks_data] == [4, None, None, None]
+
+    ee = RealtimeExecutionEngine()
+    ee._al_create_processes(tasks_data)
+    for queue, depth in [(ee._task_output_queues[0], 4), (ee._task_output_queues[1], 1)]:
+        for i in range(depth):
+            assert not queue.full()
+            queue.put(i, block = False)
+        assert queue.full()
+        assert queue.qsize() == depth
+
+    #2. Test that depth must be positive
+    with pytest.raises(ValueError):
+        IdentityProcessor(queue_depth = 0)
+
+def test_engine_keeps_tasks():
+    #2. Test that the engine keeps the tasks, since ``Process.start`` drops them before
+    # spawned processes have unpickled them and opened the queues and locks they hold.
+    A = IntProducer()
+    B = IdentityProcessor(nb_tasks = 3)(A)
+    C = CommandlineConsumer()(B)
+
+    tsort = topological_sort([A])
+    tasks_data = _task_data_from_node_tsort(tsort)
+
+    ee = RealtimeExecutionEngine(start_method = 'spawn')
+    ee._al_create_processes(tasks_data)
+    assert len(ee._tasks) == len(ee._procs)
+    assert all(proc._args[0] is task for proc, task in zip(ee._procs, ee._tasks))
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -43,6 +43,46 @@ def test_gpus_available_3(monkeypatch):
     gpus = system.get_gpus_available_to_process()
     assert len(gpus) == 2
 
+def test_number_of_gpus_cached(monkeypatch):
+    calls = []
+    def check_output_mock(args):
+        calls.append(args)
+        return b'GPU 0: Tesla V100 (UUID: GPU-0)\nGPU 1: Tesla V100 (UUID: GPU-1)\n'
+
+    monkeypatch.setattr(system.subprocess, 'check_output', check_output_mock)
+    system.get_number_of_gpus.cache_clear()
+    assert system.get_number_of_gpus() == 2
+    assert system.get_number_of_gpus() == 2
+    assert len(calls) == 1
+    system.get_number_of_gpus.cache_clear()
+
+def test_gpu_environ(monkeypatch):
+    monkeypatch.setattr(system, 'get_gpu_uuid', lambda gpu_id: 'GPU-{}'.format(gpu_id))
+    assert system.get_gpu_environ(1) == {'CUDA_VISIBLE_DEVICES': 'GPU-1'}
+
+    monkeypatch.setattr(system, 'get_gpu_uuid', lambda gpu_id: None)
+    assert system.get_gpu_environ(1) == {
+        'CUDA_DEVICE_ORDER': 'PCI_BUS_ID',
+        'CUDA_VISIBLE_DEVICES': '1'
+    }
+
+def test_parse_cpulist():
+    assert system.parse_cpulist('0-3,8,10-11\n') == set([0, 1, 2, 3, 8, 10, 11])
+    assert system.parse_cpulist('5') == set([5])
+    assert system.parse_cpulist('') == set()
+
+def test_find_numa_node():
+    numa_nodes = [set([0, 1, 2, 3]), set([4, 5, 6, 7])]
+    assert system.find_numa_node(set([5, 6]), numa_nodes) == 1
+    assert system.find_numa_node(set([3, 4, 5]), numa_nodes) == 1
+    assert system.find_numa_node(set([8]), numa_nodes) is None
+    assert system.find_numa_node(set(), []) is None
+
+def test_pick_numa_node():
+    assert system.pick_numa_node(None, [0, 0], 3) == 0
+    assert system.pick_numa_node(0, [2, 0], 3) == 0
+    assert system.pick_numa_node(0, [3, 1], 3) == 1
+    assert system.pick_numa_node(1, [3, 3], 3) == 0
 
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -96,16 +96,19 @@ class ExecutionEngine:
         '''
         - Arguments:
             - tasks_data: list of tuples. The list is of the form \
-                [(node : Node, node_index : int, parent_index : int, has_children : bool)]
+                [(node : Node, node_index : int, parent_index : int, is_last : bool, queue_depth : int)], \
+                where ``queue_depth`` is the size of the queue the task publishes to, \
+                or None to use the default of the engine.
         '''
         raise NotImplementedError('Subclass of ExecutionEnvironment must implement')
     
     def signal_flow_termination(self):
         '''
         Signals the execution environment that the flow needs to stop. \
-        When this signal is received, all consumer tasks will pick it on \
-        and pass it together with the flow until they reach every task in \
-        the graph and everyone stops working.
+        When this signal is received, all producer tasks will pick it on \
+        and send a ``STOP_SIGNAL`` message down the flow.  Every other task \
+        is blocked in ``receive_message`` and wakes up exactly once when \
+        that message reaches it, so no task needs to poll for termination.
         '''
         raise NotImplementedError('Subclass of ExecutionEnvironment must implement')
     
@@ -124,7 +127,7 @@ class ExecutionEngine:
 
         - Arguments:
             - tasks_data: list of tuples. The list is of the form \
-                [(node : Node, node_index : int, parent_index : int, has_children : bool)]
+                [(node : Node, node_index : int, parent_index : int, is_last : bool, queue_depth : int)]
 
         '''
         if self._allocation_called:
@@ -19,12 +19,17 @@ def _task_data_from_node_tsort(tsort_l):
 
     for i in range(len(tsort_l)):
         node = tsort_l[i]
+        # The queue a task publishes to is sized by the processor that reads from it
+        if i < len(tsort_l) - 1 and isinstance(tsort_l[i + 1], ProcessorNode):
+            queue_depth = tsort_l[i + 1].queue_depth
+        else:
+            queue_depth = None
         if isinstance(node, ProducerNode):
-            task_data = (node, i, None, i >= (len(tsort_l) - 1))
+            task_data = (node, i, None, i >= (len(tsort_l) - 1), queue_depth)
         elif isinstance(node, ProcessorNode):
-            task_data = (node, i, i - 1, i >= (len(tsort_l) - 1))
+            task_data = (node, i, i - 1, i >= (len(tsort_l) - 1), queue_depth)
         elif isinstance(node, ConsumerNode):
-            task_data = (node, i, i - 1, i >= (len(tsort_l) - 1))
+            task_data = (node, i, i - 1, i >= (len(tsort_l) - 1), queue_depth)
         else:
             raise ValueError('node is not of one of the valid types')
         tasks_data.append(task_data)
@@ -42,15 +47,24 @@ class Flow:
         - producers: a list of producer nodes of type ``videoflow.core.node.ProducerNode``.
         - consumers: a list of consumer nodes of type ``videoflow.core.node.ConsumerNode``.
         - flow_type: one of 'realtime' or 'batch'
+        - start_method: multiprocessing start method used to create the task processes. \
+            One of 'fork', 'spawn' or 'forkserver'.  If None, the default of the platform is used.
+        - numa_pinning: if True, on machines with more than one NUMA node each task is \
+            restricted to the cpus of one node, and tasks on a gpu to the cpus local to it. \
+            By default is False.
+        - batch_size: number of messages that a task of a 'batch' flow puts in the \
+            queue of the next task at once.  Ignored by 'realtime' flows, which drop \
+            messages instead of waiting.  By default is 1.
     '''
-    def __init__(self, producers, consumers, flow_type = REALTIME):
+    def __init__(self, producers, consumers, flow_type = REALTIME, start_method = None, numa_pinning = False,
+                batch_size = 1):
         self._graph_engine = GraphEngine(producers, consumers)
         if flow_type not in FLOW_TYPES:
             raise ValueError('flow_type must be one of {}'.format(','.join(FLOW_TYPES)))
         if flow_type == BATCH:
-            self._execution_engine = BatchExecutionEngine()
+            self._execution_engine = BatchExecutionEngine(start_method, numa_pinning, batch_size)
         elif flow_type == REALTIME:
-            self._execution_engine = RealtimeExecutionEngine()
+            self._execution_engine = RealtimeExecutionEngine(start_method, numa_pinning)
 
     def run(self):
         '''
@@ -71,14 +85,12 @@ class Flow:
         metadata_consumer = MetadataConsumer()(*tsort)
         tsort.append(metadata_consumer)
         
-        #2. TODO: OPtimize graph in the following ways:   
-        # a) Tasks do not need to pass down to children
-        # all of the outputs of parents.  Hence, at a given
-        # level of the topological sort, have the list of 
-        # inputs from parents that are not needed below that 
-        # level
+        #2. Tasks do not pass down to children the outputs of parents
+        # that are not needed below them: the execution engine drops
+        # them, using ``videoflow.utils.graph.message_ids_read_after``.
 
-        # b) Not all the processors have to write to a pub/sub channel
+        # TODO: Optimize graph in the following way:
+        # Not all the processors have to write to a pub/sub channel
         # If their output is only needed by the next preprocessor and non one
         # else below in the graph, then I can string subsequent preprocessors together
         # a big preprocessor
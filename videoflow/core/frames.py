@@ -0,0 +1,40 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # ``multiprocessing.shared_memory`` is only available on Python >= 3.8
+    shared_memory = None
+
+SharedFrame = namedtuple('SharedFrame', 'node_id name slab offset shape dtype')
+SharedFrame.__doc__ = '''
+Descriptor of a numpy array that was placed in shared memory by the execution \
+engine.  It is what travels through the queues instead of the array itself.
+'''
+
+# Shared memory segments attached by the current process, by name.
+_attached_segments = {}
+
+def decode_frame(message):
+    '''
+    If ``message`` is a ``SharedFrame``, returns a copy of the frame it refers to. \
+    Otherwise returns ``message`` unchanged.
+
+    The shared memory of a frame is reused once the message that carries it \
+    leaves the flow, so nodes get a copy they own: they can modify it in place \
+    and keep it for as long as they need.
+    '''
+    if not isinstance(message, SharedFrame):
+        return message
+    shm = _attached_segments.get(message.name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name = message.name)
+        _attached_segments[message.name] = shm
+    frame = np.ndarray(message.shape, dtype = message.dtype, buffer = shm.buf, offset = message.offset)
+    return frame.copy()
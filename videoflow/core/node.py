@@ -10,6 +10,13 @@ from .constants import LOGGING_LEVEL
 from .processor import Processor
 from .constants import GPU, CPU, DEVICE_TYPES
 
+def _rebuild_node(cls, node_id):
+    # The graph has cycles (parents <-> children), so a node can be hashed while
+    # it is being unpickled, before its state is restored.  Restore its id first.
+    node = cls.__new__(cls)
+    node._id = node_id
+    return node
+
 class Node:
     '''
     Represents a computational node in the graph. It is also a callable object. \
@@ -45,6 +52,9 @@ class Node:
     
     def __hash__(self):
         return self._id
+
+    def __reduce_ex__(self, protocol):
+        return (_rebuild_node, (self.__class__, self._id), self.__dict__)
     
     def open(self):
         '''
@@ -156,11 +166,23 @@ class ConsumerNode(Leaf):
                             by subclass')
 
 class ProcessorNode(Node):
-    def __init__(self, nb_tasks : int = 1, device_type = CPU, **kwargs):
+    '''
+    - Arguments:
+        - nb_tasks (int): number of parallel tasks to allocate to the processor.
+        - device_type (str): preferred device type to run the processor's code.
+        - queue_depth (int): number of messages that can wait in the queue \
+            the processor reads from.  If None, the execution engine decides. \
+            A slow processor after a fast task can use a deeper queue to absorb \
+            jitter, at the cost of the memory of the messages waiting in it.
+    '''
+    def __init__(self, nb_tasks : int = 1, device_type = CPU, queue_depth : int = None, **kwargs):
         self._nb_tasks = nb_tasks
         if device_type not in DEVICE_TYPES:
             raise ValueError('Device is not one of {}'.format(",".join(DEVICE_TYPES)))
         self._device_type = device_type
+        if queue_depth is not None and queue_depth < 1:
+            raise ValueError('queue_depth must be greater than zero')
+        self._queue_depth = queue_depth
         super(ProcessorNode, self).__init__(**kwargs)
 
     @property
@@ -177,6 +199,14 @@ class ProcessorNode(Node):
         '''
         return self._device_type
     
+    @property
+    def queue_depth(self):
+        '''
+        Returns the number of messages that can wait in the queue the processor \
+        reads from, or None if the execution engine decides.
+        '''
+        return self._queue_depth
+    
     def change_device(self, device_type):
         if device_type not in DEVICE_TYPES:
             raise ValueError('Device is not one of {}'.format(",".join(DEVICE_TYPES)))
@@ -3,12 +3,14 @@ from __future__ import division
 from __future__ import absolute_import
 
 import logging
+from queue import Full
 from multiprocessing import Queue, Lock
 import time
 
 from .node import Node, ProducerNode, ProcessorNode, ConsumerNode
 from .constants import STOP_SIGNAL, BATCH, REALTIME, FLOW_TYPES
 from ..utils.generic_utils import DelayedKeyboardInterrupt
+from .frames import decode_frame
 
 logger = logging.getLogger(__package__)
 
@@ -238,31 +240,41 @@ class ConsumerTask(NodeTask):
                 continue
 
 class MultiprocessingTask(Task):
-    def __init__(self, processor : ProcessorNode):
+    def __init__(self, processor : ProcessorNode, frames = None):
         self._processor = processor
+        self._processor_id = processor.id
         self._parent_nodes_ids = [a.id for a in self._processor.parents]
+        self._frames = frames
     
     def _inputs_from_raw_inputs(self, raw_inputs):
-        inputs = [raw_inputs[a]['message'] for a in self._parent_nodes_ids]
+        inputs = [decode_frame(raw_inputs[a]['message']) for a in self._parent_nodes_ids]
         return inputs
+
+    def _release_frames(self, raw_inputs):
+        # Dropped messages never reach the last task of the flow, which is the one
+        # that otherwise gives the frames in them back to their arenas.
+        if self._frames is not None:
+            self._frames.release(raw_inputs)
     
     def _metadatas_from_raw_inputs(self, raw_inputs):
         metadatas = [raw_inputs[a]['metadata'] for a in self._parent_nodes_ids]
         return metadatas
 
     def _has_stop_signal(self, raw_inputs):
-        inputs = self._inputs_from_raw_inputs(raw_inputs)
-        stop_signal_received = any([isinstance(a, str) and a == STOP_SIGNAL for a in inputs])
+        # Looks at the raw messages: decoding would copy every shared frame just to compare it.
+        messages = [raw_inputs[a]['message'] for a in self._parent_nodes_ids]
+        stop_signal_received = any([isinstance(a, str) and a == STOP_SIGNAL for a in messages])
         return stop_signal_received
 
 class MultiprocessingReceiveTask(MultiprocessingTask):
-    def __init__(self, processor: ProcessorNode, parent_task_queue : Queue, receiveQueue : Queue, flow_type : str):
+    def __init__(self, processor: ProcessorNode, parent_task_queue : Queue, receiveQueue : Queue, flow_type : str,
+                frames = None):
         self._parent_task_queue = parent_task_queue
         self._rq = receiveQueue
         if flow_type not in FLOW_TYPES:
             raise ValueError('flow_type must be one of {}'.format(','.join(FLOW_TYPES)))
         self._flow_type = flow_type
-        super(MultiprocessingReceiveTask, self).__init__(processor)
+        super(MultiprocessingReceiveTask, self).__init__(processor, frames)
 
     def run(self):
         while True:
@@ -275,10 +287,13 @@ class MultiprocessingReceiveTask(MultiprocessingTask):
                     if self._flow_type == BATCH:
                         self._rq.put(raw_inputs, block = True)
                     elif self._flow_type == REALTIME:
-                        try:
-                            self._rq.put(raw_inputs, block = False)
-                        except:
-                            pass
+                        if self._rq.full():
+                            self._release_frames(raw_inputs)
+                        else:
+                            try:
+                                self._rq.put_nowait(raw_inputs)
+                            except Full:
+                                self._release_frames(raw_inputs)
             except KeyboardInterrupt:
                 continue
 
@@ -313,7 +328,7 @@ class MultiprocessingProcessorTask(MultiprocessingTask):
                     if self._has_stop_signal(raw_inputs):
                         self._rq.put(raw_inputs, block = True)
                         raw_outputs = dict(raw_inputs)
-                        raw_outputs[self._processor.id] = {
+                        raw_outputs[self._processor_id] = {
                             'message': STOP_SIGNAL,
                             'metadata': None
                         }
@@ -323,7 +338,7 @@ class MultiprocessingProcessorTask(MultiprocessingTask):
                     #3. Else: process it, and place result in oq
                     inputs = self._inputs_from_raw_inputs(raw_inputs)
                     output = self._processor.process(*inputs)
-                    raw_inputs[self._processor.id] = {
+                    raw_inputs[self._processor_id] = {
                         'message': output,
                         'metadata': None
                     }
@@ -334,7 +349,7 @@ class MultiprocessingProcessorTask(MultiprocessingTask):
 
 class MultiprocessingOutputTask(MultiprocessingTask):
     def __init__(self, processor : ProcessorNode, task_queue : Queue, accountingQueue : Queue,
-                output_queues : [Queue], flow_type : str, is_last : bool):
+                output_queues : [Queue], flow_type : str, is_last : bool, frames = None):
         self._aq = accountingQueue
         self._task_queue = task_queue
         self._output_queues = output_queues
@@ -344,7 +359,7 @@ class MultiprocessingOutputTask(MultiprocessingTask):
         if flow_type not in FLOW_TYPES:
             raise ValueError('flow_type must be one of {}'.format(','.join(FLOW_TYPES)))
         self._flow_type = flow_type
-        super(MultiprocessingOutputTask, self).__init__(processor)
+        super(MultiprocessingOutputTask, self).__init__(processor, frames)
     
     @property
     def is_last(self):
@@ -360,7 +375,7 @@ class MultiprocessingOutputTask(MultiprocessingTask):
         while True:
             try:   
                 with DelayedKeyboardInterrupt():
-                    next_idx = self._aq.get(block = True)
+                    next_idx = self._aq.get()
                     start_2_t = time.time()
                     raw_outputs = self._output_queues[next_idx].get(block = True)
                     end_t = time.time()
@@ -368,7 +383,7 @@ class MultiprocessingOutputTask(MultiprocessingTask):
                     actual_proc_time = end_t - previous_end_t
                     previous_end_t = end_t
 
-                    raw_outputs[self._processor.id]['metadata'] = {
+                    raw_outputs[self._processor_id]['metadata'] = {
                         'proctime': proc_time,
                         'actual_proctime': actual_proc_time
                     }
@@ -383,10 +398,15 @@ class MultiprocessingOutputTask(MultiprocessingTask):
                             if self._flow_type == BATCH:
                                 self._task_queue.put(raw_outputs, block = True)
                             elif self._flow_type == REALTIME:
-                                try:
-                                    self._task_queue.put(raw_outputs, block = False)
-                                except:
-                                    pass
+                                if self._task_queue.full():
+                                    self._release_frames(raw_outputs)
+                                else:
+                                    try:
+                                        self._task_queue.put_nowait(raw_outputs)
+                                    except Full:
+                                        self._release_frames(raw_outputs)
+                    else:
+                        self._release_frames(raw_outputs)
                     if self._finish_count == len(self._output_queues):
                         break
                     
@@ -3,38 +3,62 @@ from __future__ import division
 from __future__ import absolute_import
 
 import logging
+import math
 import os
-from multiprocessing import Process, Queue, Event, Lock
+from collections import deque
+from operator import itemgetter
+from multiprocessing import Queue, Value
+from multiprocessing.util import Finalize
 
-from .task_functions import create_process_task, create_process_task_gpu, task_executor_fn, task_executor_gpu_fn
+from .queues import SPSCShmQueue, create_queue, create_accounting_queue, DEFAULT_QUEUE_DEPTH
+from .frames import SharedFrameRegistry, decode_inputs, drop_unread_messages, release_frames, DEFAULT_NB_SLABS
+from .task_functions import create_process_task, create_process_task_gpu, task_executor_fn, task_executor_gpu_fn, get_process_context, join_processes
 from ..core.constants import BATCH, REALTIME, GPU, CPU, LOGGING_LEVEL
 from ..core.node import Node, ProducerNode, ConsumerNode, ProcessorNode
 from ..core.task import Task, ProducerTask, ProcessorTask, ConsumerTask, MultiprocessingReceiveTask, MultiprocessingProcessorTask, MultiprocessingOutputTask
 from ..core.engine import ExecutionEngine, Messenger
-from ..utils.system import get_gpus_available_to_process
+from ..utils.system import get_gpus_available_to_process, get_gpu_local_cpus, get_numa_nodes_cpus, find_numa_node, pick_numa_node
+from ..utils.graph import message_ids_read_after
 from ..core.constants import STOP_SIGNAL
 
+
 class BatchprocessingQueueMessenger(Messenger):
     '''
     BatchprocessingQueueMessenger is a messenger that communicates
     through queues of type ``multiprocessing.Queue``.  It is not real
     time, which means that if a queue is full when publishing a 
     message to it, it will block until the queue can process it.
+
+    If ``batch_size`` is greater than one, published messages are put in \
+    the queue in lists of ``batch_size`` messages, so that the cost of \
+    each queue operation is shared by all the messages in the list.  The \
+    receiving side accepts both lists and single messages.
     '''
     def __init__(self, computation_node : Node, task_queue : Queue, parent_task_queue : Queue,
-        termination_event : Event):
+        termination_flag : Value, frames : SharedFrameRegistry = None, releases_frames : bool = False,
+        batch_size : int = 1, read_after : frozenset = None):
         self._computation_node = computation_node
+        self._node_id = computation_node.id
         self._parent_task_queue = parent_task_queue
         self._task_queue = task_queue
-        self._parent_nodes_ids = []
+        self._parent_nodes_ids = ()
         if self._computation_node.parents is not None:
-            self._parent_nodes_ids = [a.id for a in self._computation_node.parents]
-        self._termination_event = termination_event
+            self._parent_nodes_ids = tuple(a.id for a in self._computation_node.parents)
+        self._nb_parents = len(self._parent_nodes_ids)
+        self._get_inputs = itemgetter(*self._parent_nodes_ids) if self._nb_parents > 0 else None
+        self._termination_flag = termination_flag
         self._last_message_received = None
+        self._frames = frames
+        self._releases_frames = releases_frames and frames is not None
+        self._batch_size = batch_size
+        self._read_after = read_after
+        self._pending = []
+        self._pending_unread = []
+        self._received = deque()
         self._logger = self._configure_logger()
     
     def _configure_logger(self):
-        logger = logging.getLogger(f'{self._computation_node.id}')
+        logger = logging.getLogger(f'{self._node_id}')
         logger.setLevel(LOGGING_LEVEL)
         ch = logging.StreamHandler()
         ch.setLevel(LOGGING_LEVEL)
@@ -43,52 +67,89 @@ class BatchprocessingQueueMessenger(Messenger):
         logger.addHandler(ch)
         return logger
 
-    def publish_message(self, message, metadata = None):
+    def _put(self, message_dict, flush = False):
+        if self._task_queue is None:
+            return
+        unread = drop_unread_messages(message_dict, self._read_after)
+        if self._batch_size <= 1:
+            self._task_queue.put(message_dict, block = True)
+            release_frames(self._frames, unread)
+            return
+        self._pending.append(message_dict)
+        self._pending_unread.append(unread)
+        if flush or len(self._pending) >= self._batch_size:
+            # Same as with the envelopes, the list cannot be reused once it was put.
+            self._task_queue.put(self._pending, block = True)
+            self._pending = []
+            for unread in self._pending_unread:
+                release_frames(self._frames, unread)
+            self._pending_unread = []
+
+    def _get(self):
+        if len(self._received) == 0:
+            item = self._parent_task_queue.get()
+            if not isinstance(item, list):
+                return item
+            self._received.extend(item)
+        return self._received.popleft()
+
+    def publish_message(self, message, metadata = None, flush = False):
         '''
         Publishes output message to a place where the child task will receive it. \
         '''
+        if self._frames is not None:
+            message = self._frames.encode(self._node_id, message)
         if self._last_message_received is None:
+            # A fresh envelope is needed for every message: ``_pending`` keeps
+            # references to the envelopes until the batch is put, and the
+            # ``multiprocessing.Queue`` used when shared memory is not available
+            # (Python < 3.8) pickles them later from a feeder thread, so
+            # recycling a single dict here would corrupt queued messages.
             msg = {
-                self._computation_node.id : {
+                self._node_id : {
                     'message': message,
                     'metadata': metadata
                 }
             }
-            self._task_queue.put(msg, block = True)
+            self._put(msg, flush)
             self._logger.debug(f'Published message {msg}')
         else:
-            self._last_message_received[self._computation_node.id] = {
+            self._last_message_received[self._node_id] = {
                 'message': message,
                 'metadata': metadata
             }
-            self._task_queue.put(self._last_message_received, block = True)
+            self._put(self._last_message_received, flush)
             self._logger.debug(f'Published message {self._last_message_received}')
     
     def check_for_termination(self) -> bool:
         '''
-        Checks if someone has set a termination event.
+        Checks if someone has set the termination flag.  The flag is a plain \
+        shared int, so reading it does not take a lock.
         '''
-        return self._termination_event.is_set()
+        return self._termination_flag.value != 0
 
     def publish_termination_message(self, message, metadata = None):
         '''
-        This method is identical to publish message
+        This method is identical to publish message, but it also puts \
+        in the queue any message that is waiting for its batch to fill up.
         '''
-        return self.publish_message(message, metadata)
+        return self.publish_message(message, metadata, flush = True)
 
     def passthrough_message(self):
-        self._task_queue.put(self._last_message_received, block = True)
+        self._put(self._last_message_received)
     
     def passthrough_termination_message(self):
-        return self.passthrough_message()
+        self._put(self._last_message_received, flush = True)
     
     def receive_raw_message(self):
-        input_message_dict = self._parent_task_queue.get()
+        input_message_dict = self._get()
         self._last_message_received = input_message_dict
         self._logger.debug(f'Received message: {input_message_dict}')
         
         #1. Check for STOP_SIGNAL before returning
-        inputs = [input_message_dict[a] for a in self._parent_nodes_ids]
+        inputs = self._get_inputs(input_message_dict)
+        if self._nb_parents == 1:
+            inputs = [inputs]
         messages = [a['message'] for a in inputs]
         stop_signal_received = any([isinstance(a, str) and a == STOP_SIGNAL for a in messages])
         
@@ -99,36 +160,109 @@ class BatchprocessingQueueMessenger(Messenger):
             return dict(input_message_dict)
 
     def receive_message(self):
-        input_message_dict = self._parent_task_queue.get()
+        if self._releases_frames:
+            # The previous message is done with, and no task below this one will see it.
+            self._frames.release(self._last_message_received)
+        input_message_dict = self._get()
         self._logger.debug(f'Received message: {input_message_dict}')
         self._last_message_received = input_message_dict
-        inputs = [input_message_dict[a] for a in self._parent_nodes_ids]
+        inputs = self._get_inputs(input_message_dict)
+        if self._nb_parents == 1:
+            inputs = [inputs]
+        else:
+            inputs = list(inputs)
+        if self._frames is not None:
+            inputs = decode_inputs(inputs)
         return inputs
 
+def _reads_from_receive_task(node : Node) -> bool:
+    return isinstance(node, ProcessorNode) and node.nb_tasks > 1
+
+def _nb_slabs_per_node(node_ids, batch_sizes, queue_depths, read_after):
+    '''
+    Returns the number of slabs of the arena of each node of the flow, given the \
+    batch size and queue depth of the output of each task and the ``read_after`` \
+    sets of ``message_ids_read_after``.  A frame waits in the pending batch and the \
+    queue of every task that passes it down, so each of those edges adds the \
+    messages it holds beyond those of an unbatched edge of default depth.
+    '''
+    extra = [
+        batch_size * (1 + queue_depth) - (1 + DEFAULT_QUEUE_DEPTH) if queue_depth > 0 else 0
+        for batch_size, queue_depth in zip(batch_sizes, queue_depths)
+    ]
+    nb_slabs = {}
+    for i, node_id in enumerate(node_ids):
+        nb_slabs[node_id] = DEFAULT_NB_SLABS + extra[i] + sum(
+            extra[j] for j in range(i + 1, len(node_ids)) if node_id in read_after[j - 1]
+        )
+    return nb_slabs
+
 class BatchExecutionEngine(ExecutionEngine):
-    def __init__(self):
+    '''
+    - Arguments:
+        - start_method (str): multiprocessing start method used to create the task \
+            processes.  One of ``'fork'``, ``'spawn'`` or ``'forkserver'``.  If None, \
+            the default start method of the platform is used.
+        - numa_pinning (bool): if True and the machine has more than one NUMA node, \
+            each task is restricted to the cpus of one node, keeping consecutive \
+            tasks on the same node while the tasks stay balanced across nodes.  \
+            Tasks that run on a gpu are kept on the cpus local to it.  If False, \
+            the operating system decides where tasks run.
+        - batch_size (int): number of messages that a task puts in the queue of \
+            the next task at once, so that they share the cost of the queue operation. \
+            Tasks followed by a processor with more than one task do not batch their \
+            messages.  By default is 1, which sends every message on its own.
+    '''
+    def __init__(self, start_method : str = None, numa_pinning : bool = False, batch_size : int = 1):
+        if batch_size < 1:
+            raise ValueError('batch_size must be a positive integer')
+        self._ctx = get_process_context(start_method)
+        self._numa_pinning = numa_pinning
+        self._batch_size = batch_size
         self._procs = []
         self._tasks = []
         self._task_output_queues = {}
         self._task_termination_notification_queues = {}
-        self._termination_event = None
+        self._termination_flag = None
+        self._frames = None
         self._gpu_ids = get_gpus_available_to_process()
         self._nb_available_gpus = len(self._gpu_ids)
         self._next_gpu_index = -1
         super(BatchExecutionEngine, self).__init__()
 
     def _al_create_and_start_processes(self, tasks_data):
-        #0. Create output queues
+        #0. Create output queues.  Nobody reads the output of the last task, so it gets none.
+        queue_depths = []
         for data in tasks_data:
             task_id = data[1]
-            queue = Queue(1)
+            if data[3]:
+                queue_depths.append(0)
+                continue
+            queue_depth = data[4] if len(data) > 4 and data[4] is not None else DEFAULT_QUEUE_DEPTH
+            queue_depths.append(queue_depth)
+            queue = create_queue(queue_depth, self._ctx)
             self._task_output_queues[task_id] = queue
         
-        self._termination_event = Event()
+        self._termination_flag = self._ctx.Value('i', 0, lock = False)
+
+        # Messages are only batched when the next task also reads them through a messenger.
+        batch_sizes = [
+            self._batch_size if not data[3] and not _reads_from_receive_task(tasks_data[task_idx + 1][0]) else 1
+            for task_idx, data in enumerate(tasks_data)
+        ]
+        read_after = message_ids_read_after([data[0] for data in tasks_data])
+
+        #0.1 Create the arenas where tasks that publish through a messenger place their frames.
+        # Each arena needs room for its frames that wait in the batches and queues below its node.
+        nb_slabs = _nb_slabs_per_node([data[0].id for data in tasks_data], batch_sizes, queue_depths, read_after)
+        self._frames = SharedFrameRegistry([
+            data[0].id for data in tasks_data
+            if isinstance(data[0], ProducerNode) or (isinstance(data[0], ProcessorNode) and data[0].nb_tasks == 1)
+        ], nb_slabs = nb_slabs, ctx = self._ctx)
 
         #1. Initialize tasks
         tasks = []
-        for (data_0, data_1, data_2, data_3, *data_len) in tasks_data:
+        for task_idx, (data_0, data_1, data_2, data_3, *data_len) in enumerate(tasks_data):
             node = data_0
             node_id = data_1
             parent_node_id = data_2
@@ -140,7 +274,8 @@ class BatchExecutionEngine(ExecutionEngine):
             else:
                 parent_task_queue = None
         
-            messenger = BatchprocessingQueueMessenger(node, task_queue, parent_task_queue, self._termination_event)
+            messenger = BatchprocessingQueueMessenger(node, task_queue, parent_task_queue, self._termination_flag,
+                                    self._frames, is_last, batch_sizes[task_idx], read_after[task_idx])
 
             if isinstance(node, ProducerNode):
                 task = ProducerTask(node, messenger, node_id, is_last)
@@ -148,21 +283,22 @@ class BatchExecutionEngine(ExecutionEngine):
 
             elif isinstance(node, ProcessorNode):
                 if node.nb_tasks > 1:
-                    receiveQueue = Queue(1)
-                    accountingQueue = Queue()
-                    output_queues = [Queue() for _ in range(node.nb_tasks)]
+                    receiveQueue = self._ctx.Queue(1)
+                    accountingQueue = create_accounting_queue(self._ctx)
+                    output_queues = [self._ctx.Queue() for _ in range(node.nb_tasks)]
 
                     # Create receive task
                     receive_task = MultiprocessingReceiveTask(
                         node,
                         parent_task_queue,
                         receiveQueue,
-                        BATCH
+                        BATCH,
+                        self._frames
                     )
                     tasks.append(receive_task)
 
                     # Create processor tasks
-                    mp_tasks_lock = Lock()
+                    mp_tasks_lock = self._ctx.Lock()
                     for idx in range(node.nb_tasks):
                         mp_task = MultiprocessingProcessorTask(
                             idx,
@@ -181,7 +317,8 @@ class BatchExecutionEngine(ExecutionEngine):
                         accountingQueue,
                         output_queues,
                         BATCH,
-                        is_last
+                        is_last,
+                        self._frames
                     )
                     tasks.append(output_task)
                 else:
@@ -204,36 +341,67 @@ class BatchExecutionEngine(ExecutionEngine):
                 )
                 tasks.append(task)
         
-        #2. Create processes
+        # ``Process.start`` drops its reference to the task.  With 'spawn' and 'forkserver' the
+        # task is unpickled by the child later, so the queues and locks it holds must stay alive.
+        self._tasks = tasks
+
+        #2. Create processes.  If ``numa_pinning`` is set and the machine has more than one
+        # NUMA node, cpu tasks run on the node of the task before them, so that the queue
+        # they share stays in memory local to both.  Once a node has its share of the tasks,
+        # the next task moves to the node with the fewest.  Tasks after a gpu task follow
+        # the node of the gpu.
+        numa_nodes = get_numa_nodes_cpus() if self._numa_pinning else []
+        if len(numa_nodes) < 2:
+            numa_nodes = []
+        numa_load = [0] * len(numa_nodes)
+        numa_share = math.ceil(len(tasks) / max(len(numa_nodes), 1))
+        numa_node = None
         for task in tasks:
+            cpus = None
+            if len(numa_nodes) > 0:
+                numa_node = pick_numa_node(numa_node, numa_load, numa_share)
+                cpus = numa_nodes[numa_node]
             if isinstance(task, ProcessorTask) or isinstance(task, MultiprocessingProcessorTask):
                 if task.device_type == GPU:
                     self._next_gpu_index += 1
                     if self._next_gpu_index < self._nb_available_gpus:
-                        proc = create_process_task_gpu(task, self._gpu_ids[self._next_gpu_index])
+                        gpu_id = self._gpu_ids[self._next_gpu_index]
+                        # Keep the task on the cpus of the NUMA node the gpu is attached to.
+                        gpu_cpus = get_gpu_local_cpus(gpu_id) if self._numa_pinning else None
+                        proc = create_process_task_gpu(task, gpu_id, self._ctx, gpu_cpus)
+                        if len(numa_nodes) > 0:
+                            gpu_numa_node = find_numa_node(gpu_cpus, numa_nodes)
+                            if gpu_numa_node is not None:
+                                numa_node = gpu_numa_node
                     else:
                         try:
                             task.change_device(CPU)
-                            proc = create_process_task(task)
+                            proc = create_process_task(task, self._ctx, cpus)
                         except:
                             raise RuntimeError('No GPU available to allocate {}'.format(str(task._processor)))
                 else:
-                    proc = create_process_task(task)
+                    proc = create_process_task(task, self._ctx, cpus)
             else:
-                proc = create_process_task(task)
+                proc = create_process_task(task, self._ctx, cpus)
+            if len(numa_nodes) > 0:
+                numa_load[numa_node] += 1
             self._procs.append(proc)
         
         #3. Start processes.
         for proc in self._procs:
             proc.start()
+        # Scripts often exit right after Flow.run().  Join the tasks before the
+        # exit handlers of multiprocessing remove the semaphores they share, since
+        # tasks started with spawn or forkserver may not have attached to them yet.
+        Finalize(None, self.join_task_processes, exitpriority = 100)
     
     def signal_flow_termination(self):
-        self._termination_event.set()
+        self._termination_flag.value = 1
     
     def join_task_processes(self):
-        for proc in self._procs:
-            try:
-                proc.join()
-            except KeyboardInterrupt:
-                proc.join()
-                continue
+        join_processes(self._procs)
+        if self._frames is not None:
+            self._frames.unlink()
+        for queue in self._task_output_queues.values():
+            if isinstance(queue, SPSCShmQueue):
+                queue.unlink()
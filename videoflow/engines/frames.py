@@ -0,0 +1,209 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import secrets
+import multiprocessing
+
+import numpy as np
+
+from ..core.constants import STOP_SIGNAL
+from ..core.frames import SharedFrame, decode_frame
+from .queues import reserve_shared_memory
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # ``multiprocessing.shared_memory`` is only available on Python >= 3.8
+    shared_memory = None
+
+DEFAULT_NB_SLABS = 8
+MIN_FRAME_BYTES = 1 << 16
+
+def decode_inputs(inputs):
+    '''
+    Returns a copy of ``inputs``, a list of dictionaries of the form \
+    ``{'message': .., 'metadata': ..}``, where ``SharedFrame`` messages have \
+    been replaced by copies of the arrays they refer to.  The dictionaries themselves \
+    are not modified, so that descriptors can be passed down the flow.
+    '''
+    return [
+        {'message': decode_frame(a['message']), 'metadata': a['metadata']}
+        if isinstance(a['message'], SharedFrame) else a
+        for a in inputs
+    ]
+
+def drop_unread_messages(message_dict, read_after : frozenset):
+    '''
+    Replaces by None, in ``message_dict``, the messages of the nodes that are not \
+    in ``read_after``: tasks below the one publishing ``message_dict`` only look \
+    up the messages of their own parents, so there is no need to pickle again the \
+    ones that nobody reads.  Returns the messages dropped, or None if ``read_after`` is None.
+
+    Their frames must not be released before ``message_dict`` is put: the output \
+    of a task can be a view of one of them, such as the tuple published by ``JoinerProcessor``.
+    '''
+    if read_after is None:
+        return None
+    unread = {
+        node_id: value for node_id, value in message_dict.items()
+        if node_id not in read_after and value['message'] is not None
+        and not (isinstance(value['message'], str) and value['message'] == STOP_SIGNAL)
+    }
+    for node_id, value in unread.items():
+        message_dict[node_id] = {'message': None, 'metadata': value['metadata']}
+    return unread
+
+def release_frames(frames, message_dict):
+    '''
+    Gives back the slabs of the frames in ``message_dict`` to ``frames``, the \
+    ``SharedFrameRegistry`` of the flow, if there is one.  Messengers call it for \
+    the messages they drop, which never reach the last task of the flow.
+    '''
+    if frames is not None:
+        frames.release(message_dict)
+
+class SharedFrameArena:
+    '''
+    Ring of slabs in shared memory where a task copies the numpy arrays that \
+    it publishes, so that only a small ``SharedFrame`` descriptor needs to be \
+    pickled and sent through the queues.
+
+    The shared memory segment is created lazily by the task the first time it \
+    publishes an array, with slabs of the size of that array.  The indices of \
+    free slabs live in a queue: the task takes one before copying an array \
+    and the last task of the flow puts it back once it is done with the message. \
+    Arrays that are too small, too big for a slab, or published when there \
+    are no free slabs are sent through the queues as usual.
+
+    - Arguments:
+        - node_id: id of the node whose outputs are placed in the arena.
+        - nb_slabs (int): number of slabs in the ring.
+        - ctx: multiprocessing context used to create the queue of free slabs. \
+            Defaults to the default context.
+    '''
+    def __init__(self, node_id, nb_slabs : int = DEFAULT_NB_SLABS, ctx = None):
+        self._node_id = node_id
+        self._nb_slabs = nb_slabs
+        self._name = f'vf_{os.getpid()}_{secrets.token_hex(4)}_{node_id}'
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+        self._free_slabs = ctx.SimpleQueue()
+        for slab in range(nb_slabs):
+            self._free_slabs.put(slab)
+        self._shm = None
+        self._slab_bytes = None
+        self._disabled = shared_memory is None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_shm'] = None
+        return state
+
+    def _create_segment(self, nbytes : int):
+        try:
+            shm = shared_memory.SharedMemory(name = self._name, create = True,
+                                                size = nbytes * self._nb_slabs)
+        except OSError:
+            self._disabled = True
+            return
+        if not reserve_shared_memory(shm):
+            self._disabled = True
+            return
+        self._shm = shm
+        self._slab_bytes = nbytes
+
+    def store(self, array : np.ndarray):
+        '''
+        Copies ``array`` into a free slab and returns its ``SharedFrame`` descriptor. \
+        Returns None if the array has to be sent through the queue instead.
+        '''
+        if self._disabled or array.nbytes < MIN_FRAME_BYTES or array.dtype.hasobject:
+            return None
+        if self._shm is None:
+            self._create_segment(array.nbytes)
+            if self._disabled:
+                return None
+        if array.nbytes > self._slab_bytes:
+            return None
+        # Only this task takes slabs from the queue, so it cannot become empty
+        # between the two calls.
+        if self._free_slabs.empty():
+            return None
+        slab = self._free_slabs.get()
+        offset = slab * self._slab_bytes
+        dst = np.ndarray(array.shape, dtype = array.dtype, buffer = self._shm.buf, offset = offset)
+        dst[...] = array
+        return SharedFrame(self._node_id, self._name, slab, offset, array.shape, array.dtype.str)
+
+    def release(self, slab : int):
+        '''
+        Marks ``slab`` as free again.
+        '''
+        self._free_slabs.put(slab)
+
+    def unlink(self):
+        '''
+        Removes the shared memory segment, if the task ever created it.  Called by \
+        the execution engine once all the tasks have finished.
+        '''
+        if shared_memory is None:
+            return
+        try:
+            shm = shared_memory.SharedMemory(name = self._name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+class SharedFrameRegistry:
+    '''
+    Holds the ``SharedFrameArena`` of every node in the flow that publishes \
+    messages through a messenger.  Messengers use it to encode and decode \
+    the numpy arrays they publish and receive, and to give back slabs.
+
+    - Arguments:
+        - node_ids: ids of the nodes that get an arena.
+        - nb_slabs: number of slabs of each arena, or a dictionary with the number \
+            of slabs of the arena of each node.
+        - ctx: multiprocessing context of the processes that will use the arenas.
+    '''
+    def __init__(self, node_ids, nb_slabs = DEFAULT_NB_SLABS, ctx = None):
+        self._arenas = {}
+        if not isinstance(nb_slabs, dict):
+            nb_slabs = {node_id: nb_slabs for node_id in node_ids}
+        if shared_memory is not None:
+            self._arenas = {node_id: SharedFrameArena(node_id, nb_slabs[node_id], ctx) for node_id in node_ids}
+
+    def encode(self, node_id, message):
+        '''
+        Returns the ``SharedFrame`` descriptor of ``message`` if it is a numpy array \
+        that could be placed in the arena of ``node_id``.  Otherwise returns ``message``.
+        '''
+        if isinstance(message, np.ndarray):
+            arena = self._arenas.get(node_id)
+            if arena is not None:
+                frame = arena.store(message)
+                if frame is not None:
+                    return frame
+        return message
+
+    def release(self, message_dict):
+        '''
+        Gives back to their arenas the slabs of the frames referenced by \
+        ``message_dict``, a dictionary of the form ``{node_id: {'message': .., 'metadata': ..}}``. \
+        The descriptors are removed from ``message_dict`` so that the slabs cannot \
+        be given back twice if the dictionary is published again.
+        '''
+        if message_dict is None:
+            return
+        for node_id, value in message_dict.items():
+            message = value['message']
+            if isinstance(message, SharedFrame):
+                self._arenas[message.node_id].release(message.slab)
+                message_dict[node_id] = {'message': None, 'metadata': value['metadata']}
+
+    def unlink(self):
+        for arena in self._arenas.values():
+            arena.unlink()
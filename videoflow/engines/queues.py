@@ -0,0 +1,262 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import io
+import os
+import struct
+import multiprocessing
+from queue import Full, Empty
+from multiprocessing import Queue
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.util import Finalize
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # ``multiprocessing.shared_memory`` is only available on Python >= 3.8
+    shared_memory = None
+
+CACHE_LINE_BYTES = 64
+DEFAULT_SLOT_BYTES = 1 << 20
+# Size of the queue of an edge whose reader does not ask for a deeper one
+DEFAULT_QUEUE_DEPTH = 1
+
+_INDEX = struct.Struct('Q')
+_LENGTH = struct.Struct('q')
+_OVERFLOW = -1
+# Protocol 5 lets numpy arrays hand their data to ``buffer_callback`` instead
+# of copying it into the pickle.
+_PICKLE_PROTOCOL = 5
+
+def _round_up(n : int, multiple : int) -> int:
+    return ((n + multiple - 1) // multiple) * multiple
+
+def _dumps(obj):
+    '''
+    Pickles ``obj`` and returns the pickle together with the list of \
+    out-of-band buffers that it refers to.
+    '''
+    buffers = []
+    f = io.BytesIO()
+    # ForkingPickler only takes positional arguments.
+    ForkingPickler(f, _PICKLE_PROTOCOL, True, buffers.append).dump(obj)
+    return f.getbuffer(), [a.raw() for a in buffers]
+
+def _frame_size(payload, buffers) -> int:
+    return _LENGTH.size * (2 + len(buffers)) + len(payload) + sum(a.nbytes for a in buffers)
+
+def _write_frame(buf, offset : int, payload, buffers):
+    '''
+    Writes into ``buf`` the length of ``payload``, the number and lengths of \
+    ``buffers``, ``payload`` and the contents of each buffer, in that order.
+    '''
+    _LENGTH.pack_into(buf, offset, len(payload))
+    _LENGTH.pack_into(buf, offset + _LENGTH.size, len(buffers))
+    offset += 2 * _LENGTH.size
+    for a in buffers:
+        _LENGTH.pack_into(buf, offset, a.nbytes)
+        offset += _LENGTH.size
+    for a in (payload, *buffers):
+        buf[offset:offset + len(a)] = a
+        offset += len(a)
+
+def _read_frame(buf, offset : int):
+    '''
+    Reads a frame written by ``_write_frame`` and unpickles it.  The contents of \
+    the buffers are copied once, and numpy arrays are rebuilt on top of them.
+    '''
+    payload_bytes = _LENGTH.unpack_from(buf, offset)[0]
+    nb_buffers = _LENGTH.unpack_from(buf, offset + _LENGTH.size)[0]
+    offset += 2 * _LENGTH.size
+    sizes = []
+    for _ in range(nb_buffers):
+        sizes.append(_LENGTH.unpack_from(buf, offset)[0])
+        offset += _LENGTH.size
+    payload = bytes(buf[offset:offset + payload_bytes])
+    offset += payload_bytes
+    buffers = []
+    for size in sizes:
+        buffers.append(bytearray(buf[offset:offset + size]))
+        offset += size
+    return ForkingPickler.loads(payload, buffers = buffers)
+
+def _unlink_shared_memory(shm):
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+def reserve_shared_memory(shm) -> bool:
+    '''
+    Allocates in ``/dev/shm`` every page of the shared memory segment ``shm``. \
+    Pages are otherwise only taken when first written, and a process that writes \
+    to a segment after ``/dev/shm`` filled up is killed with SIGBUS.  Returns False, \
+    after closing and unlinking the segment, if there is not enough space for it.
+    '''
+    if not hasattr(os, 'posix_fallocate'):
+        return True
+    try:
+        os.posix_fallocate(shm._fd, 0, shm.size)
+    except OSError:
+        shm.close()
+        _unlink_shared_memory(shm)
+        return False
+    return True
+
+class SPSCShmQueue:
+    '''
+    Bounded single producer, single consumer queue backed by a ring of \
+    fixed size slots in shared memory.  It implements the subset of the \
+    ``multiprocessing.Queue`` interface used by the execution engines.
+
+    Messages are pickled straight into a slot, so there is no feeder thread \
+    and no pipe involved.  The data of numpy arrays is pickled out of band \
+    and copied from the array into the slot and back in a single copy each way.  The write index is only written by the producer \
+    and the read index only by the consumer, and each of them lives on its \
+    own cache line.  Two semaphores count free and filled slots, so both \
+    ends block without polling.  Messages that do not fit in a slot are sent \
+    through an overflow ``multiprocessing.Queue`` that preserves their order.
+
+    - Arguments:
+        - maxsize (int): number of slots in the ring.
+        - slot_bytes (int): capacity in bytes of each slot.
+        - ctx: multiprocessing context used to create the semaphores and the \
+            overflow queue.  Defaults to the default context.
+    '''
+    def __init__(self, maxsize : int, slot_bytes : int = DEFAULT_SLOT_BYTES, ctx = None):
+        if shared_memory is None:
+            raise RuntimeError('SPSCShmQueue requires multiprocessing.shared_memory (Python >= 3.8)')
+        if maxsize <= 0:
+            raise ValueError('maxsize must be a positive integer')
+        self._maxsize = maxsize
+        self._slot_bytes = slot_bytes
+        self._slot_stride = _round_up(_LENGTH.size + slot_bytes, CACHE_LINE_BYTES)
+        size = 2 * CACHE_LINE_BYTES + maxsize * self._slot_stride
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+        self._shm = shared_memory.SharedMemory(create = True, size = size)
+        if not reserve_shared_memory(self._shm):
+            raise OSError('Not enough space in /dev/shm for the queue')
+        self._buf = self._shm.buf
+        _INDEX.pack_into(self._buf, 0, 0)
+        _INDEX.pack_into(self._buf, CACHE_LINE_BYTES, 0)
+        self._free_slots = ctx.Semaphore(maxsize)
+        self._used_slots = ctx.Semaphore(0)
+        self._overflow = ctx.Queue()
+        # No exit priority: the segment must outlive the interpreter of the
+        # creating process until its children have attached to it.
+        Finalize(self, _unlink_shared_memory, args = (self._shm,))
+
+    def __getstate__(self):
+        return (self._maxsize, self._slot_bytes, self._slot_stride, self._shm,
+                self._free_slots, self._used_slots, self._overflow)
+
+    def __setstate__(self, state):
+        (self._maxsize, self._slot_bytes, self._slot_stride, self._shm,
+            self._free_slots, self._used_slots, self._overflow) = state
+        self._buf = self._shm.buf
+
+    def _write_idx(self) -> int:
+        return _INDEX.unpack_from(self._buf, 0)[0]
+
+    def _read_idx(self) -> int:
+        return _INDEX.unpack_from(self._buf, CACHE_LINE_BYTES)[0]
+
+    def _slot_offset(self, idx : int) -> int:
+        return 2 * CACHE_LINE_BYTES + (idx % self._maxsize) * self._slot_stride
+
+    def put(self, obj, block = True, timeout = None):
+        payload, buffers = _dumps(obj)
+        if not self._free_slots.acquire(block, timeout):
+            raise Full
+        idx = self._write_idx()
+        offset = self._slot_offset(idx)
+        nbytes = _frame_size(payload, buffers)
+        if nbytes <= self._slot_bytes:
+            _LENGTH.pack_into(self._buf, offset, nbytes)
+            _write_frame(self._buf, offset + _LENGTH.size, payload, buffers)
+        else:
+            _LENGTH.pack_into(self._buf, offset, _OVERFLOW)
+            frame = bytearray(nbytes)
+            _write_frame(frame, 0, payload, buffers)
+            self._overflow.put(frame)
+        _INDEX.pack_into(self._buf, 0, idx + 1)
+        self._used_slots.release()
+
+    def put_nowait(self, obj):
+        return self.put(obj, False)
+
+    def get(self, block = True, timeout = None):
+        if not self._used_slots.acquire(block, timeout):
+            raise Empty
+        idx = self._read_idx()
+        offset = self._slot_offset(idx)
+        nbytes = _LENGTH.unpack_from(self._buf, offset)[0]
+        if nbytes == _OVERFLOW:
+            obj = _read_frame(self._overflow.get(), 0)
+        else:
+            obj = _read_frame(self._buf, offset + _LENGTH.size)
+        _INDEX.pack_into(self._buf, CACHE_LINE_BYTES, idx + 1)
+        self._free_slots.release()
+        return obj
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self) -> int:
+        return self._write_idx() - self._read_idx()
+
+    def empty(self) -> bool:
+        return self.qsize() <= 0
+
+    def full(self) -> bool:
+        return self.qsize() >= self._maxsize
+
+    def unlink(self):
+        '''
+        Removes the shared memory segment of the ring.  Called by the execution \
+        engine once all the tasks using the queue have finished.
+        '''
+        _unlink_shared_memory(self._shm)
+
+def create_queue(maxsize : int, ctx = None):
+    '''
+    Returns the queue used for an edge of the flow.  Every edge of the \
+    topologically sorted flow has exactly one task writing to it and one \
+    task reading from it, so a ``SPSCShmQueue`` is used whenever shared \
+    memory is available and has room for its slots.  Otherwise it falls back \
+    to ``multiprocessing.Queue``.
+
+    The output queues of the workers of a processor with more than one task \
+    also have a single writer and a single reader, but they keep using \
+    multiprocessing queues: workers do not place their frames in an arena, so \
+    their messages seldom fit in a slot and would all go through the overflow \
+    queue, which costs an extra copy and pickle per message.
+
+    ``ctx`` is the multiprocessing context of the processes that will use the \
+    queue.  Defaults to the default context.
+    '''
+    if shared_memory is not None:
+        try:
+            return SPSCShmQueue(maxsize, ctx = ctx)
+        except OSError:
+            pass
+    if ctx is None:
+        return Queue(maxsize)
+    return ctx.Queue(maxsize)
+
+def create_accounting_queue(ctx = None):
+    '''
+    Returns the queue where each worker of a processor with more than one task \
+    writes its index when it takes an input, so that the \
+    ``MultiprocessingOutputTask`` collects the outputs in the order of the inputs.
+
+    Workers take an input and write their index while holding a lock.  With \
+    ``multiprocessing.Queue`` the index only reaches the pipe later, from a \
+    feeder thread, so indices of different workers can arrive out of order. \
+    ``SimpleQueue`` writes to the pipe before ``put`` returns.
+    '''
+    if ctx is None:
+        ctx = multiprocessing.get_context()
+    return ctx.SimpleQueue()
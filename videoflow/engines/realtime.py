@@ -3,16 +3,23 @@ from __future__ import division
 from __future__ import absolute_import
 
 import logging
+import math
 
 import os
-from multiprocessing import Process, Queue, Event, Lock
+from queue import Full
+from operator import itemgetter
+from multiprocessing import Queue, Value
+from multiprocessing.util import Finalize
 
-from .task_functions import create_process_task, create_process_task_gpu, task_executor_fn, task_executor_gpu_fn
+from .queues import SPSCShmQueue, create_queue, create_accounting_queue, DEFAULT_QUEUE_DEPTH
+from .frames import SharedFrameRegistry, decode_inputs, drop_unread_messages, release_frames, DEFAULT_NB_SLABS
+from .task_functions import create_process_task, create_process_task_gpu, task_executor_fn, task_executor_gpu_fn, get_process_context, join_processes
 from ..core.constants import BATCH, REALTIME, GPU, CPU, LOGGING_LEVEL
 from ..core.node import Node, ProducerNode, ConsumerNode, ProcessorNode
 from ..core.task import Task, ProducerTask, ProcessorTask, ConsumerTask, MultiprocessingReceiveTask, MultiprocessingProcessorTask, MultiprocessingOutputTask
 from ..core.engine import ExecutionEngine, Messenger
-from ..utils.system import get_gpus_available_to_process
+from ..utils.system import get_gpus_available_to_process, get_gpu_local_cpus, get_numa_nodes_cpus, find_numa_node, pick_numa_node
+from ..utils.graph import message_ids_read_after
 from ..core.constants import STOP_SIGNAL
 
 class RealtimeQueueMessenger(Messenger):
@@ -24,19 +31,26 @@ class RealtimeQueueMessenger(Messenger):
     publish and passthrough termination messages will block and not drop.
     '''
     def __init__(self, computation_node : Node, task_queue : Queue, parent_task_queue : Queue,
-                termination_event : Event):
+                termination_flag : Value, frames : SharedFrameRegistry = None,
+                releases_frames : bool = False, read_after : frozenset = None):
         self._computation_node = computation_node
+        self._node_id = computation_node.id
         self._parent_task_queue = parent_task_queue
         self._task_queue = task_queue
-        self._parent_nodes_ids = []
+        self._parent_nodes_ids = ()
         if self._computation_node.parents is not None:
-            self._parent_nodes_ids = [a.id for a in self._computation_node.parents]
-        self._termination_event = termination_event
+            self._parent_nodes_ids = tuple(a.id for a in self._computation_node.parents)
+        self._nb_parents = len(self._parent_nodes_ids)
+        self._get_inputs = itemgetter(*self._parent_nodes_ids) if self._nb_parents > 0 else None
+        self._termination_flag = termination_flag
         self._last_message_received = None
+        self._frames = frames
+        self._releases_frames = releases_frames and frames is not None
+        self._read_after = read_after
         self._logger = self._configure_logger()
 
     def _configure_logger(self):
-        logger = logging.getLogger(f'{self._computation_node.id}')
+        logger = logging.getLogger(f'{self._node_id}')
         logger.setLevel(LOGGING_LEVEL)
         ch = logging.StreamHandler()
         ch.setLevel(LOGGING_LEVEL)
@@ -50,46 +64,60 @@ class RealtimeQueueMessenger(Messenger):
         Publishes output message to a place where the child task will receive it. \
         Will drop the message is the receiving queue is full.
         '''
+        if self._task_queue is None:
+            return
+        # Dropping is the common case when downstream is slower than this task,
+        # so check for room first instead of paying for a raised ``Full``.
+        if self._task_queue.full():
+            self._logger.debug(f'Queue is full.')
+            release_frames(self._frames, self._last_message_received)
+            return
+        if self._frames is not None:
+            message = self._frames.encode(self._node_id, message)
         if self._last_message_received is None:
-            try:
-                msg = {
-                    self._computation_node.id : {
-                        'message': message,
-                        'metadata': metadata
-                    }
+            # A fresh envelope is needed for every message: the ``multiprocessing.Queue``
+            # used when shared memory is not available (Python < 3.8) only appends the
+            # object to a buffer that a feeder thread pickles later, so recycling a
+            # single dict here would corrupt queued messages.
+            msg = {
+                self._node_id : {
+                    'message': message,
+                    'metadata': metadata
                 }
-                self._task_queue.put(msg, block = False)
-                self._logger.debug(f'Published message {msg}')
-            except:
-                self._logger.debug(f'Queue is full.')
-                pass
+            }
         else:
-            self._last_message_received[self._computation_node.id] = {
+            self._last_message_received[self._node_id] = {
                 'message': message,
                 'metadata': metadata
             }
-            try:
-                self._task_queue.put(self._last_message_received, block = False)
-                self._logger.debug(f'Published message {self._last_message_received}')
-            except:
-                self._logger.debug(f'Queue is full.')
-                pass
+            msg = self._last_message_received
+        unread = drop_unread_messages(msg, self._read_after)
+        try:
+            self._task_queue.put_nowait(msg)
+            self._logger.debug(f'Published message {msg}')
+        except Full:
+            self._logger.debug(f'Queue is full.')
+            release_frames(self._frames, msg)
+        release_frames(self._frames, unread)
     
     def check_for_termination(self) -> bool:
         '''
-        Checks if someone has set a termination event.
+        Checks if someone has set the termination flag.  The flag is a plain \
+        shared int, so reading it does not take a lock.
         '''
-        return self._termination_event.is_set()
+        return self._termination_flag.value != 0
 
     def publish_termination_message(self, message, metadata = None):
         '''
         This method is identical to publish message, but is blocking
         Because, the termination message cannot be dropped.
         '''
+        if self._task_queue is None:
+            return
         if self._last_message_received is None:
             try:
                 msg = {
-                    self._computation_node.id : {
+                    self._node_id : {
                         'message': message,
                         'metadata': metadata
                     }
@@ -98,58 +126,107 @@ class RealtimeQueueMessenger(Messenger):
             except:
                 pass
         else:
-            self._last_message_received[self._computation_node.id] = {
+            self._last_message_received[self._node_id] = {
                 'message': message,
                 'metadata': metadata
             }
+            unread = drop_unread_messages(self._last_message_received, self._read_after)
             try:
                 self._task_queue.put(self._last_message_received, block = True)
             except:
                 pass
+            release_frames(self._frames, unread)
 
     def passthrough_message(self):
+        if self._task_queue is None:
+            return
+        if self._task_queue.full():
+            release_frames(self._frames, self._last_message_received)
+            return
+        unread = drop_unread_messages(self._last_message_received, self._read_after)
         try:
-            self._task_queue.put(self._last_message_received, block = False)
-        except:
-            pass
+            self._task_queue.put_nowait(self._last_message_received)
+        except Full:
+            release_frames(self._frames, self._last_message_received)
+        release_frames(self._frames, unread)
     
     def passthrough_termination_message(self):
+        if self._task_queue is None:
+            return
+        unread = drop_unread_messages(self._last_message_received, self._read_after)
         try:
             self._task_queue.put(self._last_message_received, block = True)
         except:
             pass
+        release_frames(self._frames, unread)
 
     def receive_message(self):
+        if self._releases_frames:
+            # The previous message is done with, and no task below this one will see it.
+            self._frames.release(self._last_message_received)
         input_message_dict = self._parent_task_queue.get()
         self._logger.debug(f'Received message: {input_message_dict}')
         self._last_message_received = input_message_dict
-        inputs = [input_message_dict[a] for a in self._parent_nodes_ids]
+        inputs = self._get_inputs(input_message_dict)
+        if self._nb_parents == 1:
+            inputs = [inputs]
+        else:
+            inputs = list(inputs)
+        if self._frames is not None:
+            inputs = decode_inputs(inputs)
         return inputs
 
 class RealtimeExecutionEngine(ExecutionEngine):
-    def __init__(self):
+    '''
+    - Arguments:
+        - start_method (str): multiprocessing start method used to create the task \
+            processes.  One of ``'fork'``, ``'spawn'`` or ``'forkserver'``.  If None, \
+            the default start method of the platform is used.
+        - numa_pinning (bool): if True and the machine has more than one NUMA node, \
+            each task is restricted to the cpus of one node, keeping consecutive \
+            tasks on the same node while the tasks stay balanced across nodes.  \
+            Tasks that run on a gpu are kept on the cpus local to it.  If False, \
+            the operating system decides where tasks run.
+    '''
+    def __init__(self, start_method : str = None, numa_pinning : bool = False):
+        self._ctx = get_process_context(start_method)
+        self._numa_pinning = numa_pinning
         self._procs = []
         self._tasks = []
         self._task_output_queues = {}
         self._task_termination_notification_queues = {}
-        self._termination_event = None
+        self._termination_flag = None
+        self._frames = None
         self._gpu_ids = get_gpus_available_to_process()
         self._nb_available_gpus = len(self._gpu_ids)
         self._next_gpu_index = -1
         super(RealtimeExecutionEngine, self).__init__()
         
     def _al_create_processes(self, tasks_data):
-        #0. Create output queues
+        #0. Create output queues.  Nobody reads the output of the last task, so it gets none.
+        # Frames wait in the queues, so arenas get a slab for every extra place in them.
+        extra_depth = 0
         for data in tasks_data:
             task_id = data[1]
-            queue = Queue(1)
+            if data[3]:
+                continue
+            queue_depth = data[4] if len(data) > 4 and data[4] is not None else DEFAULT_QUEUE_DEPTH
+            extra_depth += queue_depth - DEFAULT_QUEUE_DEPTH
+            queue = create_queue(queue_depth, self._ctx)
             self._task_output_queues[task_id] = queue
         
-        self._termination_event = Event()
+        self._termination_flag = self._ctx.Value('i', 0, lock = False)
+
+        #0.1 Create the arenas where tasks that publish through a messenger place their frames
+        self._frames = SharedFrameRegistry([
+            data[0].id for data in tasks_data
+            if isinstance(data[0], ProducerNode) or (isinstance(data[0], ProcessorNode) and data[0].nb_tasks == 1)
+        ], nb_slabs = DEFAULT_NB_SLABS + extra_depth, ctx = self._ctx)
 
         #1. Initialize tasks
+        read_after = message_ids_read_after([data[0] for data in tasks_data])
         tasks = []
-        for data in tasks_data:
+        for task_idx, data in enumerate(tasks_data):
             node = data[0]
             node_id = data[1]
             parent_node_id = data[2]
@@ -162,7 +239,8 @@ class RealtimeExecutionEngine(ExecutionEngine):
             else:
                 parent_task_queue = None
         
-            messenger = RealtimeQueueMessenger(node, task_queue, parent_task_queue, self._termination_event)
+            messenger = RealtimeQueueMessenger(node, task_queue, parent_task_queue, self._termination_flag,
+                                            self._frames, is_last, read_after[task_idx])
 
             if isinstance(node, ProducerNode):
                 task = ProducerTask(node, messenger, node_id, is_last)
@@ -170,21 +248,22 @@ class RealtimeExecutionEngine(ExecutionEngine):
 
             elif isinstance(node, ProcessorNode):
                 if node.nb_tasks > 1:
-                    receiveQueue = Queue(1)
-                    accountingQueue = Queue()
-                    output_queues = [Queue() for _ in range(node.nb_tasks)]
+                    receiveQueue = self._ctx.Queue(1)
+                    accountingQueue = create_accounting_queue(self._ctx)
+                    output_queues = [self._ctx.Queue() for _ in range(node.nb_tasks)]
 
                     # Create receive task
                     receive_task = MultiprocessingReceiveTask(
                         node,
                         parent_task_queue,
                         receiveQueue,
-                        REALTIME
+                        REALTIME,
+                        self._frames
                     )
                     tasks.append(receive_task)
 
                     # Create processor tasks
-                    mp_tasks_lock = Lock()
+                    mp_tasks_lock = self._ctx.Lock()
                     for idx in range(node.nb_tasks):
                         mp_task = MultiprocessingProcessorTask(
                             idx,
@@ -203,7 +282,8 @@ class RealtimeExecutionEngine(ExecutionEngine):
                         accountingQueue,
                         output_queues,
                         REALTIME,
-                        is_last
+                        is_last,
+                        self._frames
                     )
                     tasks.append(output_task)
                 else:
@@ -226,41 +306,72 @@ class RealtimeExecutionEngine(ExecutionEngine):
                 )
                 tasks.append(task)
         
-        #2. Create processes
+        # ``Process.start`` drops its reference to the task.  With 'spawn' and 'forkserver' the
+        # task is unpickled by the child later, so the queues and locks it holds must stay alive.
+        self._tasks = tasks
+
+        #2. Create processes.  If ``numa_pinning`` is set and the machine has more than one
+        # NUMA node, cpu tasks run on the node of the task before them, so that the queue
+        # they share stays in memory local to both.  Once a node has its share of the tasks,
+        # the next task moves to the node with the fewest.  Tasks after a gpu task follow
+        # the node of the gpu.
+        numa_nodes = get_numa_nodes_cpus() if self._numa_pinning else []
+        if len(numa_nodes) < 2:
+            numa_nodes = []
+        numa_load = [0] * len(numa_nodes)
+        numa_share = math.ceil(len(tasks) / max(len(numa_nodes), 1))
+        numa_node = None
         for task in tasks:
+            cpus = None
+            if len(numa_nodes) > 0:
+                numa_node = pick_numa_node(numa_node, numa_load, numa_share)
+                cpus = numa_nodes[numa_node]
             if isinstance(task, ProcessorTask) or isinstance(task, MultiprocessingProcessorTask):
                 if task.device_type == GPU:
                     self._next_gpu_index += 1
                     if self._next_gpu_index < self._nb_available_gpus:
-                        proc = create_process_task_gpu(task, self._gpu_ids[self._next_gpu_index])
+                        gpu_id = self._gpu_ids[self._next_gpu_index]
+                        # Keep the task on the cpus of the NUMA node the gpu is attached to.
+                        gpu_cpus = get_gpu_local_cpus(gpu_id) if self._numa_pinning else None
+                        proc = create_process_task_gpu(task, gpu_id, self._ctx, gpu_cpus)
+                        if len(numa_nodes) > 0:
+                            gpu_numa_node = find_numa_node(gpu_cpus, numa_nodes)
+                            if gpu_numa_node is not None:
+                                numa_node = gpu_numa_node
                     else:
                         try:
                             task.change_device(CPU)
-                            proc = create_process_task(task)
+                            proc = create_process_task(task, self._ctx, cpus)
                         except:
                             raise RuntimeError('No GPU available to allocate {}'.format(str(task._processor)))
                 else:
-                    proc = create_process_task(task)
+                    proc = create_process_task(task, self._ctx, cpus)
             else:
-                proc = create_process_task(task)
+                proc = create_process_task(task, self._ctx, cpus)
+            if len(numa_nodes) > 0:
+                numa_load[numa_node] += 1
             self._procs.append(proc)
 
     def _al_start_processes(self):
         #3. Start processes.
         for proc in self._procs:
             proc.start()
+        # Scripts often exit right after Flow.run().  Join the tasks before the
+        # exit handlers of multiprocessing remove the semaphores they share, since
+        # tasks started with spawn or forkserver may not have attached to them yet.
+        Finalize(None, self.join_task_processes, exitpriority = 100)
 
     def _al_create_and_start_processes(self, tasks_data):
         self._al_create_processes(tasks_data)
         self._al_start_processes()
         
     def signal_flow_termination(self):
-        self._termination_event.set()
+        self._termination_flag.value = 1
     
     def join_task_processes(self):
-        for proc in self._procs:
-            try:
-                proc.join()
-            except KeyboardInterrupt:
-                proc.join()
-                continue
\ No newline at end of file
+        join_processes(self._procs)
+        if self._frames is not None:
+            self._frames.unlink()
+        for queue in self._task_output_queues.values():
+            if isinstance(queue, SPSCShmQueue):
+                queue.unlink()
\ No newline at end of file
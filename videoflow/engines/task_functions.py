@@ -5,25 +5,72 @@ from __future__ import absolute_import
 import logging
 
 import os
-from multiprocessing import Process, Queue, Event, Lock
+import multiprocessing
+from multiprocessing.connection import wait
 
 from ..core.task import Task
+from ..utils.system import get_gpu_environ, set_process_cpu_affinity
 
-def task_executor_fn(task : Task):
-    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# Modules imported once by the fork server, so that task processes forked
+# from it do not need to import them again.  Missing modules are skipped.
+FORKSERVER_PRELOAD = ['numpy', 'cv2', 'videoflow']
+
+def get_process_context(start_method : str = None):
+    '''
+    Returns the multiprocessing context used to create the task processes \
+    and the queues and locks they share.  If ``start_method`` is None, the \
+    default start method of the platform is used.
+
+    With ``'forkserver'``, task processes are forked from a small server process \
+    instead of from the process that runs the flow, so they do not inherit the \
+    modules and models loaded in it.  Nodes need to be picklable, and the \
+    script that runs the flow needs an ``if __name__ == '__main__':`` guard.
+    '''
+    ctx = multiprocessing.get_context(start_method)
+    if ctx.get_start_method() == 'forkserver':
+        ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return ctx
+
+def task_executor_fn(task : Task, cpus : set = None):
     os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+    if cpus is not None:
+        set_process_cpu_affinity(cpus)
     task.run()
 
-def task_executor_gpu_fn(task : Task, gpu_id : int):
-    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+def task_executor_gpu_fn(task : Task, environ : dict, cpus : set = None):
+    # CUDA reads the environment when it is initialized, which happens when the
+    # task opens its processor, not when a framework is imported.
+    os.environ.update(environ)
+    if cpus is not None:
+        set_process_cpu_affinity(cpus)
     task.run()
 
-def create_process_task(task):
-    proc = Process(target = task_executor_fn, args = (task,))
+def create_process_task(task, ctx = None, cpus : set = None):
+    if ctx is None:
+        ctx = multiprocessing.get_context()
+    proc = ctx.Process(target = task_executor_fn, args = (task, cpus))
     return proc
 
-def create_process_task_gpu(task, gpu_id):
-    proc = Process(target = task_executor_gpu_fn, args = (task, gpu_id))
+def create_process_task_gpu(task, gpu_id, ctx = None, cpus : set = None):
+    # The gpu is looked up here, so that the task process does not need to query NVML.
+    if ctx is None:
+        ctx = multiprocessing.get_context()
+    environ = get_gpu_environ(gpu_id)
+    proc = ctx.Process(target = task_executor_gpu_fn, args = (task, environ, cpus))
     return proc
 
+def join_processes(procs):
+    '''
+    Blocks until every process in ``procs`` has finished.  The calling process \
+    waits once on the sentinels of all the processes that are still running, \
+    and joins each one as it exits.  ``KeyboardInterrupt`` does not stop the \
+    wait, since tasks finish on their own once the flow is told to stop.
+    '''
+    running = {proc.sentinel: proc for proc in procs}
+    while len(running) > 0:
+        try:
+            finished = wait(list(running))
+        except KeyboardInterrupt:
+            continue
+        for sentinel in finished:
+            running.pop(sentinel).join()
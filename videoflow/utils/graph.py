@@ -86,3 +86,26 @@ def topological_sort(producers):
             _topological_sort_util(v, visited, stack)
     
     return stack
+
+def message_ids_read_after(tsort):
+    '''
+    For each position of a topological sort, finds the nodes whose output \
+    messages are read by some node that comes later in the sort.  Consumers \
+    created with ``metadata = True`` only read the metadata of their parents, \
+    so they do not count.
+
+    - Arguments:
+        - tsort: a list of nodes in topological order.
+
+    - Returns:
+        - read_after: a list of frozensets of node ids.  The set at position ``i`` \
+            has the ids of the nodes whose output is read by the nodes at positions ``> i``.
+    '''
+    read_after = [None] * len(tsort)
+    ids = frozenset()
+    for i in range(len(tsort) - 1, -1, -1):
+        read_after[i] = ids
+        node = tsort[i]
+        if node.parents is not None and not getattr(node, 'metadata', False):
+            ids = ids | frozenset(a.id for a in node.parents)
+    return read_after
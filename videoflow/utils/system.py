@@ -1,9 +1,15 @@
 import subprocess
 import os
+from functools import lru_cache
 
+PCI_DEVICES_PATH = '/sys/bus/pci/devices'
+NUMA_NODES_PATH = '/sys/devices/system/node'
+
+@lru_cache(maxsize = None)
 def get_number_of_gpus() -> int:
     '''
-    Returns the number of gpus in the system
+    Returns the number of gpus in the system.  The gpus in the system do not \
+    change while the process is running, so ``nvidia-smi`` is only called once.
     '''
     try:
         n = str(subprocess.check_output(["nvidia-smi", "-L"])).count('UUID')
@@ -25,8 +31,11 @@ def get_gpus_available_to_process() -> [int]:
     available by ``CUDA_VISIBLE_DEVICES``. It returns the intersection of those
     two sets as a list.
     '''
-    system_devices = get_system_gpus()
     env_var = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    if env_var is not None and len(env_var.strip()) == 0:
+        # No gpu is visible, so there is no need to enumerate them.
+        return []
+    system_devices = get_system_gpus()
     if env_var is None:
         visible_devices = set(system_devices)
     else:
@@ -45,4 +54,171 @@ def get_gpus_available_to_process() -> [int]:
     return list(available_devices)
 
 
-    
\ No newline at end of file
+    
+
+def parse_cpulist(cpulist : str) -> set:
+    '''
+    Parses a cpu list in the format used by the Linux kernel (i.e.: ``0-3,8,10-11``) \
+    and returns the ids of the cpus in it as a set of integers.
+    '''
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def _query_gpu(gpu_id : int, nvml_query, smi_field : str) -> str:
+    # Asks NVML for a property of the gpu, or ``nvidia-smi`` if ``pynvml`` is not installed.
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_id)
+            value = nvml_query(pynvml, handle)
+        finally:
+            pynvml.nvmlShutdown()
+        if isinstance(value, bytes):
+            value = value.decode()
+    except ImportError:
+        try:
+            value = subprocess.check_output(["nvidia-smi", "--query-gpu={}".format(smi_field),
+                "--format=csv,noheader", "-i", str(gpu_id)]).decode()
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            return None
+    except Exception:
+        return None
+    value = value.strip()
+    if len(value) == 0:
+        return None
+    return value
+
+@lru_cache(maxsize = None)
+def get_gpu_pci_bus_id(gpu_id : int) -> str:
+    '''
+    Returns the PCI bus id of the gpu in the format used by sysfs \
+    (i.e.: ``0000:3b:00.0``), or None if it cannot be determined.
+
+    ``gpu_id`` is a physical gpu index, as returned by ``get_gpus_available_to_process``. \
+    Those ids are not affected by ``CUDA_VISIBLE_DEVICES``, and match the NVML \
+    indices because both NVML and ``CUDA_DEVICE_ORDER=PCI_BUS_ID`` enumerate \
+    devices in PCI bus order.
+    '''
+    bus_id = _query_gpu(gpu_id, lambda nvml, handle: nvml.nvmlDeviceGetPciInfo(handle).busId, 'pci.bus_id')
+    if bus_id is None:
+        return None
+    # NVML uses an 8 digit PCI domain, sysfs uses 4 digits.
+    return bus_id[-12:].lower()
+
+@lru_cache(maxsize = None)
+def get_gpu_uuid(gpu_id : int) -> str:
+    '''
+    Returns the UUID of the gpu with physical index ``gpu_id`` \
+    (i.e.: ``GPU-8f6e...``), or None if it cannot be determined.
+    '''
+    return _query_gpu(gpu_id, lambda nvml, handle: nvml.nvmlDeviceGetUUID(handle), 'uuid')
+
+def get_gpu_environ(gpu_id : int) -> dict:
+    '''
+    Returns the environment variables that make the gpu with physical index \
+    ``gpu_id`` the only one visible to CUDA.  The gpu is named by its UUID, \
+    which does not depend on the order in which CUDA enumerates devices.  If the \
+    UUID cannot be determined, the index is used together with ``PCI_BUS_ID`` \
+    ordering, which matches the NVML indices.
+    '''
+    uuid = get_gpu_uuid(gpu_id)
+    if uuid is not None:
+        return {'CUDA_VISIBLE_DEVICES': uuid}
+    return {
+        'CUDA_DEVICE_ORDER': 'PCI_BUS_ID',
+        'CUDA_VISIBLE_DEVICES': str(gpu_id)
+    }
+
+def get_gpu_local_cpus(gpu_id : int) -> set:
+    '''
+    Returns the set of ids of the cpus that are in the same NUMA node as the gpu, \
+    or an empty set if that information is not available.
+    '''
+    bus_id = get_gpu_pci_bus_id(gpu_id)
+    if bus_id is None:
+        return set()
+    try:
+        with open(os.path.join(PCI_DEVICES_PATH, bus_id, 'local_cpulist')) as f:
+            return parse_cpulist(f.read())
+    except (OSError, ValueError):
+        return set()
+
+def get_numa_nodes_cpus() -> [set]:
+    '''
+    Returns a list with the set of ids of the cpus of each NUMA node in the \
+    machine.  Only cpus that the calling process is allowed to run on are \
+    included, and nodes left without cpus are skipped.  Returns an empty list \
+    if the information is not available.
+    '''
+    if not hasattr(os, 'sched_getaffinity'):
+        return []
+    allowed = os.sched_getaffinity(0)
+    try:
+        names = sorted(a for a in os.listdir(NUMA_NODES_PATH)
+                        if a.startswith('node') and a[4:].isdigit())
+    except OSError:
+        return []
+    nodes = []
+    for name in names:
+        try:
+            with open(os.path.join(NUMA_NODES_PATH, name, 'cpulist')) as f:
+                cpus = parse_cpulist(f.read()) & allowed
+        except (OSError, ValueError):
+            continue
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    return nodes
+
+def find_numa_node(cpus : set, numa_nodes : [set]) -> int:
+    '''
+    Returns the index of the NUMA node in ``numa_nodes`` that has the most \
+    cpus in common with ``cpus``, or None if no node has any.
+    '''
+    best = None
+    best_overlap = 0
+    for idx, node in enumerate(numa_nodes):
+        overlap = len(node & cpus)
+        if overlap > best_overlap:
+            best, best_overlap = idx, overlap
+    return best
+
+def pick_numa_node(preferred : int, load : [int], share : int) -> int:
+    '''
+    Returns the index of the NUMA node where to place the next task.  That is \
+    ``preferred`` if fewer than ``share`` tasks were placed on it, and otherwise \
+    the node with the fewest tasks.
+
+    - Arguments:
+        - preferred (int): index of the node of the task before, or None.
+        - load (list): number of tasks placed on each node so far.
+        - share (int): number of tasks each node is meant to get.
+    '''
+    if preferred is not None and load[preferred] < share:
+        return preferred
+    return min(range(len(load)), key = lambda a: load[a])
+
+def set_process_cpu_affinity(cpus : set) -> bool:
+    '''
+    Restricts the calling process to run on ``cpus``.  Cpus that the process is \
+    not allowed to run on already are ignored.  Returns True if the affinity was changed.
+    '''
+    if not hasattr(os, 'sched_setaffinity'):
+        return False
+    cpus = set(cpus) & os.sched_getaffinity(0)
+    if len(cpus) == 0:
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError:
+        return False
+    return True